@@ -1,26 +1,61 @@
 import sys
 import csv
 import gzip
+import multiprocessing
+
+CHUNK_SIZE = 1 << 20 # Bytes of contig FASTA copied at a time
+
+def copy_contig(fasta, out):
+  """Appends the sequence of a gzipped single record FASTA file to out, a
+     chunk at a time. Returns the length of the sequence."""
+  length = 0
+  with gzip.open(fasta, 'rb') as f:
+    f.readline() # Header
+    for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+      seq = chunk.translate(None, b' \t\r\n')
+      out.write(seq)
+      length += len(seq)
+  return length
+
+def concatenate(job):
+  """Writes the strain's contigs, in order, to <strain>.concat, and the
+     offset index of each contig (contig, start, length) to
+     <strain>.concat.idx. Returns the strain and its index."""
+  strain, contigs, path_to_contigs = job
+  index, start = list(), 0
+  with open(strain + '.concat', 'wb') as out:
+    for contig_id in contigs:
+      length = copy_contig(path_to_contigs + contig_id + '.fasta.gz', out)
+      index.append((contig_id, start, length))
+      start += length
+  with open(strain + '.concat.idx', 'w') as f:
+    f.write('contig\tstart\tlength\n')
+    for contig_id, start, length in index:
+      f.write(f'{contig_id}\t{start}\t{length}\n')
+  return strain, index
 
 def main():
-  if len(sys.argv) != 3:
-    print("Usage: <exe> <contig_concat> <path_to_contigs>")
+  if len(sys.argv) not in (3, 4):
+    print("Usage: <exe> <contig_concat> <path_to_contigs> [<workers>]")
     sys.exit()
 
   with open(sys.argv[1]) as f:
     contig_list = [line for line in csv.reader(f)]
     contig_list.pop(0)
+  workers = int(sys.argv[3]) if len(sys.argv) == 4 else multiprocessing.cpu_count()
+
+  # Each strain's contigs, in the order they are concatenated. The position
+  # column is always 0: contigs are located by the offset index instead
+  strains = dict()
+  for strain, contig_id, position in contig_list:
+    strains.setdefault(strain, list()).append(contig_id)
 
-  for strain, contig_id, pos in contig_list:
-    print(contig_id)
-    with gzip.open(sys.argv[2] + contig_id + '.fasta.gz', 'r') as f:
-      fa = [l.strip().decode('utf-8') for l in f]
-      fa.pop(0)
-    with open(strain + '.concat', 'a') as g:
-      g.write(''.join(fa))
+  jobs = [(strain, contigs, sys.argv[2]) for strain, contigs in strains.items()]
+  with multiprocessing.Pool(min(workers, len(jobs)) or 1) as pool:
+    for strain, index in pool.imap_unordered(concatenate, jobs):
+      print(f'{strain}: {len(index)} contigs, {sum(length for c, s, length in index)} bases, '
+            f'offsets in {strain}.concat.idx')
 
 
 if __name__ == '__main__':
   main()
-      
-    
@@ -0,0 +1,151 @@
+# Author: Izaak Coleman
+# email: izaak.coleman1@gmail.com
+import heapq
+import math
+
+import DBG
+
+__version__ = 0.1
+
+def locate(dbg, kmers):
+  """Returns kmer -> (unitig, offset) for each of kmers found in the
+     compressed De Bruijn graph dbg."""
+  found = dict()
+  for unitig in dbg.nodes:
+    for i in range(0, len(unitig) - dbg.k + 1):
+      if unitig[i:i+dbg.k] in kmers:
+        found[unitig[i:i+dbg.k]] = (unitig, i)
+  return found
+
+def successors(dbg):
+  """Returns unitig -> [(next unitig, bitmask of dbs of the edge joining them)]."""
+  succ = {unitig: list() for unitig in dbg.nodes}
+  for (u, v), meta in dbg.edges.items():
+    if u != DBG.DUMMY_NODE:
+      succ[u].append((v, meta[DBG.DBS]))
+  return succ
+
+def distances(dbg, succ, ends):
+  """Returns unitig -> the fewest bases a path must add, beyond the end of
+     the unitig, to end an amplicon (negative if the amplicon ends within
+     the unitig), for each unitig from which an amplicon end is reachable.
+     ends maps unitig -> amplicon end positions within it."""
+  pred = {unitig: list() for unitig in dbg.nodes}
+  for u, vs in succ.items():
+    for v, dbs in vs:
+      pred[v].append(u)
+  dist = {u: min(e - len(u) for e in es) for u, es in ends.items()}
+  heap = [(d, u) for u, d in dist.items()]
+  heapq.heapify(heap)
+  while heap:
+    d, v = heapq.heappop(heap)
+    if d > dist[v]:
+      continue
+    d += len(v) - (dbg.k - 1) # Bases added by extending a path into v
+    for u in pred[v]:
+      if d < dist.get(u, math.inf):
+        dist[u] = d
+        heapq.heappush(heap, (d, u))
+  return dist
+
+def amplicons(dbg, p1_probes, p2_probes, max_len=-1, max_paths=-1):
+  """Enumerates the paths of the compressed (coloured) De Bruijn graph dbg
+     from the start of a p1* probe to the end of a p2* probe, yielding each
+     distinct amplicon and the bitmask of databases containing all of it.
+
+     Paths are followed depth first, pruned where no database contains
+     every edge of the path (the AND of its colours is 0), or where no
+     amplicon of at most max_len bases (-1 for no limit) can be completed.
+     So at a bubble, a path only branches if the databases containing it
+     differ in their branch. A path may go round a cycle (e.g. the copies
+     of a tandem repeat's unit) again only if its last lap added a unitig
+     or edge the path lacked: k-mers are only present or absent, so a
+     further identical copy is not supported by any database's k-mers. A
+     repeat is therefore followed up to the copies its k-mers tell apart,
+     and the colour of an amplicon is the databases containing each of its
+     k-mers, which for a repeat includes those with more (identical) copies.
+     Enumeration stops after max_paths amplicons (-1 for no limit)."""
+  k = dbg.k
+  max_len = math.inf if max_len < 0 else max_len
+  found = locate(dbg, {p[:k] for p in p1_probes} | {p[-k:] for p in p2_probes})
+  starts = sorted({found[p[:k]] for p in p1_probes if p[:k] in found})
+  ends = dict()
+  for p in p2_probes:
+    if p[-k:] in found:
+      unitig, offset = found[p[-k:]]
+      ends.setdefault(unitig, set()).add(offset + k)
+  succ = successors(dbg)
+  dist = distances(dbg, succ, ends)
+  colour = lambda u: dbg.nodes[u][DBG.DBS]
+
+  seen = set()
+  full = lambda: 0 <= max_paths <= len(seen)
+  def ending(unitig, length, dbs):
+    """Yields the new amplicons of the current path (of pieces) ending in
+       its last unitig, of length bases."""
+    for end in sorted(ends.get(unitig, ())):
+      amplicon = ''.join(pieces)[:length - (len(unitig) - end)]
+      if k < len(amplicon) <= max_len and amplicon not in seen and not full():
+        seen.add(amplicon)
+        yield amplicon, dbs
+
+  for start, offset in starts:
+    length, dbs = len(start) - offset, colour(start)
+    if start not in dist or length + dist[start] > max_len:
+      continue
+    pieces = [start[offset:]] # The sequence each unitig of the path adds to the amplicon
+    # Unitig or edge into a unitig (from None, for the start) -> times on the path
+    visits = {start: 1, (None, start): 1}
+    at = {start: [0]} # Unitig -> the depths on the path it is visited at
+    news = [2] # Number of the path's first visits (of a unitig or edge), up to each depth
+    frames = [((None, start), start, iter(succ[start]), length, dbs)]
+    yield from ending(start, length, dbs)
+    while frames and not full():
+      edge, unitig, children, length, dbs = frames[-1]
+      child = next(children, None)
+      if child is None:
+        frames.pop()
+        pieces.pop()
+        news.pop()
+        at[unitig].pop()
+        for x in (unitig, edge):
+          visits[x] -= 1
+        continue
+      v, edge_dbs = child
+      v_dbs = dbs & edge_dbs & colour(v)
+      v_length = length + len(v) - (k - 1)
+      if v_dbs == 0 or v not in dist or v_length + dist[v] > max_len:
+        continue
+      new = (not visits.get(v)) + (not visits.get((unitig, v)))
+      if at.get(v) and news[-1] - news[at[v][-1]] + new == 0:
+        continue # The lap since v's last visit added nothing
+      pieces.append(v[k-1:])
+      for x in (v, (unitig, v)):
+        visits[x] = visits.get(x, 0) + 1
+      at.setdefault(v, list()).append(len(frames))
+      news.append(news[-1] + new)
+      frames.append(((unitig, v), v, iter(succ[v]), v_length, v_dbs))
+      yield from ending(v, v_length, v_dbs)
+    if full():
+      print(f'Warning: amplicon enumeration stopped at the limit of {max_paths} amplicons, '
+            f'so amplicons may be missing')
+      return
+
+def db_names(dbs, db_dict):
+  """Returns the comma separated names of the databases in a bitmask of dbs."""
+  names = {i: name for name, i in db_dict.items()}
+  return ','.join(names[i] for i in DBG.mask_to_dbs(dbs))
+
+def write(amplicons, db_dict, fname):
+  """Writes amplicons, (sequence, bitmask of dbs) pairs, to the FASTA file
+     fname.fa and the TSV file fname.tsv as they are enumerated. Returns
+     the number of amplicons per bitmask of dbs."""
+  groups = dict()
+  with open(fname + '.fa', 'w') as fa, open(fname + '.tsv', 'w') as tsv:
+    tsv.write('amplicon\tlength\tn_dbs\tdbs\tsequence\n')
+    for i, (amplicon, dbs) in enumerate(amplicons):
+      names = db_names(dbs, db_dict)
+      fa.write(f'>amplicon_{i} length={len(amplicon)} dbs={names}\n{amplicon}\n')
+      tsv.write(f'amplicon_{i}\t{len(amplicon)}\t{bin(dbs).count("1")}\t{names}\t{amplicon}\n')
+      groups[dbs] = groups.get(dbs, 0) + 1
+  return groups
@@ -0,0 +1,90 @@
+# Author: Izaak Coleman
+# email: izaak.coleman1@gmail.com
+import csv
+import itertools
+import sys
+
+import iPCR
+import Trace
+
+__version__ = 0.1
+
+def read_pairs(fname):
+  """Reads a table of probe pairs. The table is a csv file with a header
+     naming (at least) the columns p1 and p2, and optionally region, which
+     names the pair's outputs. Returns a list of (region, p1, p2)."""
+  with open(fname) as f:
+    rows = list(csv.DictReader(f))
+  return [(row.get('region') or str(i), row['p1'].strip().upper(), row['p2'].strip().upper())
+          for i, row in enumerate(rows)]
+
+class BatchPCR:
+  """Runs iPCR for many probe pairs in one session.
+
+     A single querier (one Mantis process or pool, loaded once) is shared by
+     an iPCR instance per pair, each keeping its own De Bruijn graph and
+     frontier. Every round, the queries of all pairs still extending are
+     concatenated into one batch, and the results routed back to each pair
+     in order. Pairs that finish drop out of later rounds."""
+
+  def __init__(self, pairs, mantis_exec=str(), mantis_ds=str(), max_p1_mismatch=int(),
+               max_p2_mismatch=int(), k=int(), max_extension=int(), cache_file=None,
+               workers=1, max_memory=None, backend='mantis', indels=False, max_frontier=-1,
+               canonical=True, packed=None, trace=None, collapse_bubbles=False,
+               track_unitigs=False):
+    """pairs: list of (region, p1, p2)."""
+    self.regions = [region for region, p1, p2 in pairs]
+    self.track_unitigs, self.collapse_bubbles = track_unitigs, collapse_bubbles
+    self.trace = Trace.Trace() if trace is None else trace # Per round statistics, over all pairs
+    self.qm, self.cache = iPCR.make_querier(mantis_exec, mantis_ds, None, cache_file,
+                                            workers, max_memory, backend, k + 1, canonical)
+    self.pcrs = [iPCR.iPCR(p1, p2, mantis_exec, mantis_ds, max_p1_mismatch, max_p2_mismatch,
+                           k, max_extension, qm=self.qm, indels=indels, max_frontier=max_frontier,
+                           canonical=canonical, packed=packed,
+                           collapse_bubbles=collapse_bubbles, track_unitigs=track_unitigs)
+                 for region, p1, p2 in pairs]
+
+  def query_merged(self, q_lists, consumers):
+    """Queries the q_lists of several pairs as one batch, passing the results
+       of each q_list, in order, to the corresponding consumer (e.g. the pair's
+       iPCR.update), which must read them all."""
+    results = self.trace.timed(self.qm.iter_query([q for q_list in q_lists for q in q_list]))
+    for q_list, consume in zip(q_lists, consumers):
+      consume(itertools.islice(results, len(q_list)))
+    for _ in results: # Complete the batch, so the querier is ready for the next
+      pass
+
+  def end_round(self, pcrs, frontier, q_lists):
+    """Records a round of the pairs pcrs in the trace."""
+    saved = sum(pcr.frontier.rounds[-1][1] for pcr in pcrs if pcr.frontier.rounds)
+    self.trace.end_round(self.qm, frontier, sum(map(len, q_lists)), saved,
+                         sum(len(pcr.dbg.nodes) for pcr in self.pcrs),
+                         sum(len(pcr.dbg.edges) for pcr in self.pcrs),
+                         sum(pcr.unitigs() for pcr in self.pcrs) if self.track_unitigs else None,
+                         sum(pcr.collapsed() for pcr in self.pcrs) if self.collapse_bubbles else None)
+
+  def run(self):
+    """Constructs the De Bruijn graph of every pair. Returns a dict of
+       region -> De Bruijn graph."""
+    # Initialize each pair's De Bruijn graph from its p1* and p2* probes
+    self.trace.begin_round(self.qm)
+    q_lists = [pcr.probe_queries() for pcr in self.pcrs]
+    self.query_merged(q_lists, [pcr.add_probes for pcr in self.pcrs])
+    self.end_round(self.pcrs, 0, q_lists)
+
+    # Extend every pair still extending by one round per batch
+    active = [pcr for pcr in self.pcrs if not pcr.done()]
+    rnd = 0
+    while len(active) > 0:
+      rnd += 1
+      self.trace.begin_round(self.qm)
+      frontier = sum(len(pcr.frontier) for pcr in active)
+      q_lists = [pcr.round_queries() for pcr in active]
+      print(f'round {rnd}: {len(active)} pairs extending, {sum(map(len, q_lists))} queries')
+      self.query_merged(q_lists, [pcr.update for pcr in active])
+      self.end_round(active, frontier, q_lists)
+      active = [pcr for pcr in active if not pcr.done()]
+      sys.stdout.flush()
+
+    self.qm.terminate()
+    return {region: pcr.dbg for region, pcr in zip(self.regions, self.pcrs)}
@@ -0,0 +1,154 @@
+# Author: Izaak Coleman
+# email: izaak.coleman1@gmail.com
+
+__version__ = 0.1
+
+ALPHA = 'ACGT'
+
+class Bubble:
+  """A branch of the forward search, likely the start of a SNP bubble. The
+     leader branch keeps extending, while the follower branches are parked."""
+
+  def __init__(self, leader, followers, bases=str(), leader_dbs=0):
+    self.leader = leader # The leader's last edge
+    self.followers = followers # Parked follower edge -> (depth, bitmask of dbs)
+    self.bases = bases # Bases the leader has extended by since the branch
+    self.leader_dbs = leader_dbs # Bitmask of dbs of the leader's first edge
+
+  def state(self):
+    return self.leader, self.followers, self.bases, self.leader_dbs
+
+class Bubbles:
+  """Collapses the SNP bubbles of the forward search as the De Bruijn graph
+     grows, rather than extending each of their branches. This is a lossy
+     heuristic (see below).
+
+     A SNP opens k + 1 parallel edges, each of which would be extended (four
+     queries per round) until the branches rejoin. Instead, where the
+     search branches, the branch contained by the most databases (the
+     leader) extends alone, and the others (followers) are parked. Once the
+     leader has extended k bases without branching, each follower edge is
+     verified by a single query of the follower edge followed by those k
+     bases (2k + 1 bases, its k + 1 edges), whose last node is the leader's.
+     If every database containing the follower edge contains the whole
+     branch, the branch is added to the graph, coloured by those databases.
+     Otherwise, or if the leader stops first, the follower is unparked and
+     extended as usual. Where the leader branches, it continues along the
+     branch contained by the most databases.
+
+     The nodes of parked and collapsed branches have not been extended
+     from. So a path that reaches one extends from it, rather than stopping
+     as at other nodes already in the graph. But paths leaving the branch
+     part way along, in databases that contain it (e.g. where the branch is
+     also part of a repeat), are not searched for: every split of the
+     search is parked, not only SNPs, and the single verification query
+     cannot show that a branch has no such exit, so sequence can be lost.
+     Each collapsed branch is recorded, with those of its databases that
+     the kept (leader) branch is not in: their paths through the bubble
+     were not searched node by node."""
+
+  def __init__(self, k):
+    self.k = k
+    self.open = list() # Bubbles whose leader is extending
+    self.ready = list() # Bubbles to verify in the next round
+    self.verifying = list() # Bubbles verified by the current round's queries
+    self.collapsed, self.unparked = 0, 0 # Follower branches collapsed, and unparked
+    self.branches = list() # Collapsed: (branch, bitmask of dbs, of those the leader is not in)
+    self.nodes = set() # Nodes (keys) of parked and collapsed branches, not yet extended from
+
+  def __len__(self):
+    return len(self.open) + len(self.ready) + len(self.verifying)
+
+  def queries(self):
+    """Returns the verification queries of the next round, one per follower
+       of each bubble whose leader has extended k bases."""
+    self.verifying, self.ready = self.ready, list()
+    return [f + bubble.bases for bubble in self.verifying for f in bubble.followers]
+
+  def update(self, dbg, extended):
+    """Advances the leader of each bubble, unparking the followers of those
+       whose leader stopped, and opens a bubble wherever the
+       edges extended this round (edge -> depth) branch from one node.
+       Returns the edges to extend: extended, less the parked followers and
+       with the unparked."""
+    extended, unparked = dict(extended), dict()
+    still_open = list()
+    for bubble in self.open:
+      children = [bubble.leader[1:] + base for base in ALPHA if bubble.leader[1:] + base in extended]
+      if len(children) == 0:
+        unparked.update(self.unpark(dbg, bubble.followers))
+        continue
+      bubble.leader = self.major(dbg, children)
+      bubble.bases += bubble.leader[-1]
+      (self.ready if len(bubble.bases) == self.k else still_open).append(bubble)
+    self.open = still_open
+
+    siblings = dict()
+    for edge in extended:
+      siblings.setdefault(edge[:-1], list()).append(edge)
+    for edges in siblings.values():
+      if len(edges) < 2:
+        continue
+      leader = self.major(dbg, edges)
+      followers = {edge: (extended.pop(edge), dbg.colour(dbg.key(edge)))
+                   for edge in edges if edge != leader}
+      self.nodes.update(dbg.key(edge[1:]) for edge in followers)
+      self.open.append(Bubble(leader, followers, leader_dbs=dbg.colour(dbg.key(leader))))
+    extended.update(unparked)
+    return extended
+
+  def verify(self, query_results, dbg, stop_nodes):
+    """Collapses the followers verified by the query results of queries(),
+       adding their branches to dbg. A branch is collapsed if it is contained
+       by every database that contains its follower edge, and none of its
+       new nodes are in the graph or in stop_nodes (where paths end).
+       Returns the edges added, and the followers (edge -> depth) to extend.
+       The kept branch's edges out of the node where a branch rejoins it were
+       added by the same round's queries, so its continuation is known."""
+    added, unparked = list(), dict()
+    followers = ((bubble, f) for bubble in self.verifying for f in bubble.followers)
+    for (bubble, follower), q_res in zip(followers, query_results):
+      depth, dbs = bubble.followers[follower]
+      branch = q_res.query
+      edges = [branch[i:i+self.k+1] for i in range(1, self.k + 1)]
+      # The last edge rejoins the leader's node
+      if q_res.dbs != dbs or any(dbg.has_read_node(e[1:]) or e[1:] in stop_nodes for e in edges[:-1]):
+        unparked.update(self.unpark(dbg, {follower: bubble.followers[follower]}))
+        continue
+      for edge in edges:
+        dbg.add_edge(edge, dbs)
+      self.nodes.update(dbg.key(e[1:]) for e in edges[:-1])
+      added += edges
+      self.collapsed += 1
+      self.branches.append((branch, dbs, dbs & ~bubble.leader_dbs))
+    self.verifying = list()
+    return added, unparked
+
+  def major(self, dbg, edges):
+    """Returns the edge contained by the most databases."""
+    return max(edges, key=lambda edge: bin(dbg.colour(dbg.key(edge))).count('1'))
+
+  def extend_from(self, key):
+    """Returns whether a node (key) is of a parked or collapsed branch and
+       has not been extended from, marking it extended from."""
+    if key in self.nodes:
+      self.nodes.discard(key)
+      return True
+    return False
+
+  def unpark(self, dbg, followers):
+    """Returns the followers (edge -> depth) to extend as usual."""
+    self.unparked += len(followers)
+    self.nodes.difference_update(dbg.key(f[1:]) for f in followers)
+    return {f: depth for f, (depth, dbs) in followers.items()}
+
+  def state(self):
+    """Returns the bubbles' state between rounds."""
+    return ([b.state() for b in self.open], [b.state() for b in self.ready],
+            self.collapsed, self.unparked, self.nodes, self.branches)
+
+  def restore(self, state):
+    open_bubbles, ready, self.collapsed, self.unparked, self.nodes, self.branches = state
+    self.open = [Bubble(*b) for b in open_bubbles]
+    self.ready = [Bubble(*b) for b in ready]
+    self.verifying = list()
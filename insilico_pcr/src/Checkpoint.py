@@ -0,0 +1,66 @@
+# Author: Izaak Coleman
+# email: izaak.coleman1@gmail.com
+import gzip
+import os
+import pickle
+import time
+
+__version__ = 0.1
+
+FORMAT_VERSION = 6
+COMPRESS_LEVEL = 3 # gzip level: checkpoints are written often, so favour speed
+
+def save(fname, state):
+  """Writes a checkpoint of state (built of python primitives) to fname,
+     gzipped. The checkpoint is written to a temporary file that then replaces
+     fname, so a failure while writing leaves the previous checkpoint intact."""
+  tmp = fname + '.tmp'
+  with gzip.open(tmp, 'wb', compresslevel=COMPRESS_LEVEL) as f:
+    pickle.dump((FORMAT_VERSION, state), f, protocol=pickle.HIGHEST_PROTOCOL)
+  os.replace(tmp, fname)
+
+def load(fname):
+  """Returns the state saved in the checkpoint fname, or None if there is no
+     readable checkpoint."""
+  if not os.path.isfile(fname):
+    return None
+  try:
+    with gzip.open(fname, 'rb') as f:
+      version, state = pickle.load(f)
+  except (OSError, EOFError, ValueError, pickle.UnpicklingError) as e:
+    print(f'Ignoring unreadable checkpoint {fname}: {e}')
+    return None
+  if version != FORMAT_VERSION:
+    print(f'Ignoring checkpoint {fname} of format version {version}')
+    return None
+  return state
+
+class Checkpointer:
+  """Decides when a run is checkpointed: every_rounds rounds or every_seconds
+     seconds (whichever comes first, -1 to disable either) after the last
+     checkpoint."""
+
+  def __init__(self, fname, every_rounds=-1, every_seconds=-1):
+    self.fname = fname
+    self.every_rounds, self.every_seconds = every_rounds, every_seconds
+    self.reset()
+
+  def reset(self):
+    self.rounds, self.last = 0, time.monotonic()
+
+  def due(self):
+    """Counts a completed round, returning whether a checkpoint is due."""
+    self.rounds += 1
+    return ((self.every_rounds > 0 and self.rounds >= self.every_rounds) or
+            (self.every_seconds > 0 and time.monotonic() - self.last >= self.every_seconds))
+
+  def save(self, state):
+    save(self.fname, state)
+    self.reset()
+
+  def load(self):
+    return load(self.fname)
+
+  def remove(self):
+    if os.path.isfile(self.fname):
+      os.remove(self.fname)
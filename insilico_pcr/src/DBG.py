@@ -1,41 +1,216 @@
 # Author: Izaak Coleman
 # email: izaak.coleman1@gmail.com
 
-from graphviz import Digraph 
 import sys
+import collections
+import KmerBackend
+import Unitigs
 
 DBS = 0
 FREQ = 1
+STRAND = 2 # Canonical graphs only: bitmask of the strands an edge was added on
+FORWARD, REVERSE = 1, 2
+STRAND_BITS = 2
+STRAND_MASK = (1 << STRAND_BITS) - 1
 IN, OUT = 0, 1
 UNDEFINED = 1
 ALPHA = 'ACGT'
 DUMMY_NODE = ''
+UNSEEN = (0, 0) # [dbs, freq] of an edge not in the graph
+MAX_PACKED_K = 32 # Longest edge whose packed kmer fits in a uint64
+TO_DIGITS = str.maketrans('ACGT', '0123')
+# The four bases packed into each byte value
+BYTE_BASES = [''.join(ALPHA[(b >> s) & 3] for s in (6, 4, 2, 0)) for b in range(0, 256)]
+
+def mask_to_dbs(mask):
+  """Returns the list of database indices set in a colour bitmask."""
+  dbs, i = list(), 0
+  while mask:
+    if mask & 1:
+      dbs.append(i)
+    mask >>= 1
+    i += 1
+  return dbs
+
+def pack(seq):
+  """Returns a kmer packed into an int, 2 bits per base (A=0, C=1, G=2, T=3),
+     the first base most significant."""
+  return int(seq.translate(TO_DIGITS), 4)
+
+def unpack(x, n):
+  """Returns the kmer of n bases packed into x."""
+  seq = ''.join(BYTE_BASES[b] for b in x.to_bytes((n + 3) // 4, 'big'))
+  return seq[len(seq) - n:]
+
+def strands(key, strand):
+  """Returns the canonical edge key on each strand of a strand bitmask."""
+  edges = [key] if strand & FORWARD else []
+  if strand & REVERSE:
+    edges.append(KmerBackend.reverse_complement(key))
+  return edges
 
 class DBG: 
   """Stores a python-based De Bruijn graph implementation that allows building
-     on the fly."""
+     on the fly.
 
-  def __init__(self, k):
+     If canonical, the graph is bidirected: a kmer and its reverse complement
+     are one node, stored (like edges) as the smaller of the two strings, and
+     each edge records the strands it was added on (both, e.g., for the
+     edges of an inverted repeat). Membership is tested with
+     has_node()/has_edge(), which accept either strand. The nodes are also
+     recorded on the strands they were read on (as the prefix or suffix of
+     an added edge), and has_read_node() tests a node on its own strand: a
+     path that walks into the reverse complement of a node (e.g. through a
+     palindromic edge, or an inverted repeat) has not been there before.
+
+     If track_unitigs, the unitigs of the graph (on the strands its edges
+     were added on) are kept up to date as edges are added (see Unitigs),
+     so that their number is known at any time and compress() does not
+     recompute them."""
+
+  def __init__(self, k, canonical=False, track_unitigs=False):
     self.nodes = set()
-    self.edges = dict() # k = edge, v = [set of dbs, frequency]
+    self.edges = dict() # k = edge, v = [bitmask of dbs, frequency(, strand)]
     self.k = int(k)
+    self.canonical = canonical
+    self.read = set() if canonical else None # Canonical graphs only: nodes, as read
     self.compressed = False
+    self.unitigs = Unitigs.Unitigs(self.stranded_meta) if track_unitigs else None
 
 
   def add_edge(self, edge, dbs):
     """Extends the De Bruijin graph by a single edge. 
 
-       If the suffix of the edge (prefix, suffix) is present in the De Brujin graph, 
-       add_edge returns false."""
+       dbs is the bitmask of databases containing the edge (bit i set for 
+       database i), and is OR-ed into the edge's colour."""
     
     prefix, suffix = self.get_nodes(edge)
-    self.nodes.add(prefix)
-    self.nodes.add(suffix)
-    if edge in self.edges:
-      self.edges[edge][DBS] = self.edges[edge][DBS].union(set(dbs))
-      self.edges[edge][FREQ] += 1
+    if self.canonical:
+      key = KmerBackend.canonical(edge)
+      self.nodes.add(KmerBackend.canonical(prefix))
+      self.nodes.add(KmerBackend.canonical(suffix))
+      self.read.add(prefix)
+      self.read.add(suffix)
     else:
-      self.edges[edge] = [set(dbs), 1]
+      key = edge
+      self.nodes.add(prefix)
+      self.nodes.add(suffix)
+    meta = self.edges.get(key)
+    if meta is not None:
+      changed = meta[DBS] | dbs != meta[DBS]
+      meta[DBS] |= dbs
+      meta[FREQ] += 1
+      if self.canonical:
+        strand = FORWARD if key == edge else REVERSE
+        changed = changed or not meta[STRAND] & strand
+        meta[STRAND] |= strand
+    elif self.canonical:
+      self.edges[key] = [dbs, 1, FORWARD if key == edge else REVERSE]
+    else:
+      self.edges[key] = [dbs, 1]
+    if self.unitigs is not None and (meta is None or changed):
+      for stranded in self.stranded(key):
+        self.unitigs.add(stranded)
+
+  def state(self):
+    """Returns the graph's edges (and read nodes), from which restore()
+       rebuilds the graph."""
+    return self.edges, self.read
+
+  def restore(self, state):
+    """Replaces the graph's edges (and with them its nodes) by those of a
+       state(), e.g. from a checkpoint."""
+    (self.edges, self.read), self.nodes = state, set()
+    for edge in self.edges:
+      prefix, suffix = self.get_nodes(edge)
+      self.nodes.add(self.key(prefix))
+      self.nodes.add(self.key(suffix))
+    self.restore_unitigs()
+
+  def restore_unitigs(self):
+    """Recomputes the tracked unitigs of a restored graph."""
+    if self.unitigs is not None:
+      self.unitigs = Unitigs.Unitigs(self.stranded_meta)
+      for edge, meta in self.stranded_edges():
+        self.unitigs.add(edge)
+
+  def key(self, seq):
+    """Returns the string that a node or edge is stored as."""
+    return KmerBackend.canonical(seq) if self.canonical else seq
+
+  def colour(self, key):
+    """Returns the colour of the edge stored as key, or None if it is absent."""
+    meta = self.edges.get(key)
+    return None if meta is None else meta[DBS]
+
+  def unpacked(self):
+    """Returns the graph, with its nodes and edges as strings."""
+    return self
+
+  def has_node(self, node):
+    return self.key(node) in self.nodes
+
+  def has_read_node(self, node):
+    """Returns whether node was read, on its own strand, as the prefix or
+       suffix of an added edge. The same as has_node() if not canonical."""
+    if self.read is None:
+      return self.has_node(node)
+    return self.read_key(node) in self.read
+
+  def read_key(self, node):
+    """Returns what a read node is recorded as."""
+    return node
+
+  def has_edge(self, edge):
+    return self.key(edge) in self.edges
+
+  def stranded(self, key):
+    """Returns the edge stored as key, on each strand it was added on."""
+    if not self.canonical:
+      return [key]
+    return strands(key, self.edges[key][STRAND])
+
+  def stranded_meta(self, edge):
+    """Returns the [bitmask of dbs, frequency] of edge if it was added on
+       that strand, else UNSEEN."""
+    key = self.key(edge)
+    if key not in self.edges or edge not in self.stranded(key):
+      return UNSEEN
+    return self.edges[key][:STRAND]
+
+  def stranded_edges(self):
+    """Yields each edge, on each strand it was added on, and its [bitmask
+       of dbs, frequency]."""
+    for edge, meta in self.edges.items():
+      if not self.canonical:
+        yield edge, meta
+        continue
+      for stranded in strands(edge, meta[STRAND]):
+        yield stranded, meta[:STRAND]
+
+  def make_stranded(self):
+    """Converts a canonical graph to a (single stranded) graph of its edges
+       on the strands they were added on."""
+    if not self.canonical:
+      return
+    edges = list(self.stranded_edges())
+    self.nodes, self.edges, self.canonical, self.read = set(), dict(), False, None
+    for edge, meta in edges:
+      prefix, suffix = self.get_nodes(edge)
+      self.nodes.add(prefix)
+      self.nodes.add(suffix)
+      self.edges[edge] = meta
+
+  def stranded_copy(self):
+    """Returns a (single stranded) DBG of strings of the graph's edges, on
+       the strands they were added on, leaving the graph unchanged."""
+    dbg = DBG(self.k)
+    for edge, meta in self.stranded_edges():
+      prefix, suffix = dbg.get_nodes(edge)
+      dbg.nodes.add(prefix)
+      dbg.nodes.add(suffix)
+      dbg.edges[edge] = meta
+    return dbg
 
   def get_nodes(self, sequence):
     """Takes a sequence and splits it into the prefix and suffix node
@@ -44,92 +219,273 @@ class DBG:
       raise Exception(f'edge {sequence} is not of length {self.k + 1} (k + 1)')
     return (sequence[:self.k], sequence[1:])
 
-  def render(self, fname):
-    """Renders the dbg into a PDF format."""
-    g = Digraph()
-    if not self.compressed:
-      for edge, meta in self.edges.items():
-        dbs, freq = meta
-        p, s = edge[:self.k], edge[1:]
-        for i in range(0, freq):
-          g.edge(p, s, label = s[-1])
+  def render(self, fname, max_nodes=-1):
+    """Renders the dbg into a PDF format, one edge per edge, labelled with
+       its frequency where above 1. Graphs of more than max_nodes nodes
+       (-1 for no limit) are subsampled to the max_nodes nodes nearest
+       their sources (breadth first). A canonical graph is rendered as a
+       stranded copy, and is not changed."""
+    if self.canonical:
+      return self.stranded_copy().render(fname, max_nodes)
+    from graphviz import Digraph
+    if self.compressed:
+      edges = [(p, s, s[self.k-1], 1) for (p, s) in self.edges if p != DUMMY_NODE]
     else:
-      for p, s in self.edges:
-        g.edge(p, s, label = s[self.k-1])
+      edges = [(e[:self.k], e[1:], e[-1], meta[FREQ]) for e, meta in self.edges.items()]
+    nodes = list(self.nodes)
+    if 0 <= max_nodes < len(nodes):
+      print(f'Rendering the {max_nodes} nodes nearest the sources of {len(nodes)} nodes to {fname}')
+      nodes = set(self.nearest(nodes, edges, max_nodes))
+      edges = [e for e in edges if e[0] in nodes and e[1] in nodes]
+    g = Digraph()
+    for node in nodes:
+      g.node(node)
+    for p, s, base, freq in edges:
+      g.edge(p, s, label = base if freq <= 1 else f'{base} x{freq}')
     g.render(fname) 
 
+  def nearest(self, nodes, edges, n):
+    """Returns the n nodes nearest (breadth first) the sources of the graph
+       of nodes and edges, (prefix, suffix, ...) tuples."""
+    succ, has_pred = dict(), set()
+    for e in edges:
+      succ.setdefault(e[0], list()).append(e[1])
+      has_pred.add(e[1])
+    # Seeded by the sources, then (for cycles) by any node not yet reached
+    seeds = iter([node for node in nodes if node not in has_pred] + list(nodes))
+    seen, order, queue = set(), list(), collections.deque()
+    while len(order) < n:
+      if not queue:
+        queue.append(next(seeds))
+      node = queue.popleft()
+      if node in seen:
+        continue
+      seen.add(node)
+      order.append(node)
+      queue.extend(succ.get(node, ()))
+    return order
+
   def abbreviate(self, seq):
     if len(seq) > 6:
       return seq[:3] + '...' + seq[-3:]
 
   def compress(self):
-    self.compressed = True
-    """Compresses the De Bruijn graph, replacing unitig paths with single nodes. """
-    # Construct all unitigs of length > 1. 
-    # A unitig is path of nodes v_1, ..., v_n, where indegree(v_i) = outdegree(v_i) = 1 
-    # for 1 < i < j, and indegree(v_1) != 1, outdegree(v_1) = 1, indegree(v_n) = 1, 
-    # outdegree(v_n) != 1. 
-    unitigs = set()
-    for node in self.nodes:
-      unitig_path = self.get_unitig(node)
-      unitigs.add(tuple(unitig_path))
+    """Compresses the De Bruijn graph, replacing unitig paths with single nodes.
+       Colours are preserved: unitigs are split where the colour of their
+       edges changes, so each compressed node maps to its [bitmask of dbs,
+       coverage (mean frequency of its edges)], and each compressed edge to
+       the [bitmask of dbs, frequency] of the edge joining its unitigs. A
+       unitig of a single kmer has no edges of its own, so it is coloured by
+       the OR of its incident edges' colours, its coverage their mean frequency.
+       If the unitigs are tracked, they are not recomputed."""
+    if self.unitigs is not None:
+      unitigs, meta = self.unitigs.paths(), self.stranded_meta
+    else:
+      self.make_stranded()
+      unitigs, meta = self.get_unitigs(), lambda edge: self.edges.get(edge, UNSEEN)
 
-    # Delete all nodes and edges from graph
-    # and rebuild compressed dbg from unitigs
-    self.nodes, self.edges = set(), set()
-    for unitig_path in unitigs:
-      unitig = unitig_path[0] + ''.join([node[-1] for node in unitig_path[1:]])
-      self.nodes.add(unitig)
+    # Rebuild the compressed dbg from the unitigs
+    nodes, edges = dict(), dict()
+    first, last = dict(), dict() # First and last node of each unitig -> unitig
     for unitig_path in unitigs:
       unitig = unitig_path[0] + ''.join([node[-1] for node in unitig_path[1:]])
+      metas = [meta(unitig[i:i+self.k+1]) for i in range(0, len(unitig_path) - 1)]
+      if not metas: # A single kmer has no edges of its own: use its incident edges
+        metas = [m for m in [meta(base + unitig) for base in ALPHA] + [meta(unitig + base) for base in ALPHA]
+                 if m[FREQ]]
+      dbs = 0
+      for m in metas:
+        dbs |= m[DBS]
+      coverage = sum(m[FREQ] for m in metas) / len(metas) if metas else 0
+      nodes[unitig] = [dbs, coverage]
+      first[unitig_path[0]], last[unitig_path[-1]] = unitig, unitig
+    for unitig in nodes:
       prefix, suffix = unitig[:self.k-1], unitig[-(self.k-1):]
       unconnected = True
-      for node in self.nodes:
-        for base in ALPHA:
-          if   node.startswith(suffix + base):
-            self.edges.add( (unitig, node) )
-            unconnected = False
-          elif node.endswith(base + prefix):
-            self.edges.add( (node, unitig) )
-            unconnected = False
+      for base in ALPHA:
+        if suffix + base in first:
+          edges[(unitig, first[suffix + base])] = list(meta(unitig[-self.k:] + base))
+          unconnected = False
+        if base + prefix in last:
+          edges[(last[base + prefix], unitig)] = list(meta(base + unitig[:self.k]))
+          unconnected = False
       if unconnected:
-        self.edges.add((DUMMY_NODE, unitig))
-
-  def get_unitig(self, node):
-    """Finds the unitig of a node."""
-    in_adj, out_adj = self.get_adjacent(node, IN), self.get_adjacent(node, OUT)
-    if len(in_adj) == 1 and len(out_adj) == 1:
-      return self.extend_unitig(in_adj[0], IN) + [node] + self.extend_unitig(out_adj[0], OUT)
-    elif len(in_adj) == 1:
-      return self.extend_unitig(in_adj[0], IN) + [node]
-    elif len(out_adj) == 1:
-      return [node] + self.extend_unitig(out_adj[0], OUT)
-    return [node]
+        edges[(DUMMY_NODE, unitig)] = list(UNSEEN)
+    self.nodes, self.edges = nodes, edges
+    self.canonical, self.compressed, self.unitigs, self.read = False, True, None, None
+
+  def get_unitigs(self):
+    """Returns the unitigs of a (single stranded) graph, each as its path of nodes.
+       A unitig is path of nodes v_1, ..., v_n, where indegree(v_i) = outdegree(v_i) = 1
+       for 1 < i < n, and indegree(v_1) != 1, outdegree(v_1) = 1, indegree(v_n) = 1,
+       outdegree(v_n) != 1, and whose edges all have the same colour: a path
+       is split before each edge whose colour differs from the edge before
+       it. Isolated cycles form unitigs starting after such an edge, or if
+       their edges all have one colour, at their smallest node. These are
+       the unitigs that Unitigs maintains as edges are added.
+
+       Each node is visited once: nodes are indexed by their k-1 prefix and
+       suffix, so that the nodes adjacent to each are found by a single
+       lookup, and each unitig is walked (iteratively) from its first node."""
+    # k-1 prefix (suffix) -> the node with that prefix (suffix), or None if there are several
+    by_prefix, by_suffix = dict(), dict()
+    for node in self.nodes:
+      prefix, suffix = node[:-1], node[1:]
+      by_prefix[prefix] = None if prefix in by_prefix else node
+      by_suffix[suffix] = None if suffix in by_suffix else node
+
+    def next_node(node):
+      """Returns the node following node in its unitig, or None. The edge
+         u -> v is within a unitig if it is u's only edge out, and v's only
+         edge in."""
+      overlap = node[1:]
+      if by_suffix[overlap] is None:
+        return None
+      return by_prefix.get(overlap)
+
+    def colour(u, v):
+      return self.edges.get(u + v[-1], UNSEEN)[DBS]
+
+    def walk(start, prev_colour=None):
+      """Walks the unitig from start, splitting it where the colour of its
+         edges changes. prev_colour is the colour of the edge into start."""
+      unitig_path, node = [start], next_node(start)
+      while node is not None and node != start:
+        c = self.edges.get(unitig_path[-1] + node[-1], UNSEEN)[DBS]
+        if prev_colour is not None and c != prev_colour:
+          unitigs.append(unitig_path)
+          unitig_path = [node]
+        else:
+          unitig_path.append(node)
+        prev_colour = c
+        node = next_node(node)
+      unitigs.append(unitig_path)
+
+    unitigs = list()
+    for node in self.nodes:
+      overlap = node[:-1]
+      if by_suffix.get(overlap) is None or by_prefix[overlap] is None: # First node of a unitig
+        walk(node)
+    if sum(len(u) for u in unitigs) < len(self.nodes): # Walk the remaining isolated cycles
+      visited = set(node for u in unitigs for node in u)
+      for node in self.nodes:
+        if node not in visited:
+          cycle, v = [node], next_node(node)
+          while v != node:
+            cycle.append(v)
+            v = next_node(v)
+          visited.update(cycle)
+          colours = [colour(u, v) for u, v in zip(cycle, cycle[1:] + cycle[:1])]
+          # The edge from cycle[i] starts a new colour
+          cuts = [i for i in range(0, len(cycle)) if colours[i-1] != colours[i]]
+          start = (cuts[0] + 1) % len(cycle) if cuts else cycle.index(min(cycle))
+          walk(cycle[start], colours[start-1])
+    return unitigs
 
   def get_adjacent(self, node, direction):
     if direction == IN:
-      return [c + node[:-1] for c in ALPHA if (c + node[:-1]) in self.nodes]
+      return [c + node[:-1] for c in ALPHA if self.has_node(c + node[:-1])]
     else: # direction == OUT
-      return [node[1:] + c  for c in ALPHA if (node[1:] + c)  in self.nodes]
-
-  def extend_unitig(self, node, direction):
-    in_nodes, out_nodes = self.get_adjacent(node, IN), self.get_adjacent(node, OUT)
-    # if there is more than one edge out of the node in the direction the recursion
-    # came from (we have reached a node that then branches into our unitig, and
-    # another, do not include this node in the unitig
-    if direction == IN and len(out_nodes) > 1:
-      return []
-    elif direction == OUT and len(in_nodes) > 1:
-      return []
-    # If there is one edge out of the node in the direction the recursion came from
-    # (we have hit a node with no further edges in the way we are going,
-    # or that in the direction we are heading) include the node in the unitig
-    if direction == IN and len(in_nodes) != 1:
-      return [node]
-    elif direction == OUT and len(out_nodes) != 1:
-      return [node]
-    # Otherwise, indegree = outdegree == 1, so move in same direction to the next node
-    if direction == IN:
-      return self.extend_unitig(in_nodes[0], direction) + [node]
-    else: # direction == OUT
-      return [node] + self.extend_unitig(out_nodes[0], direction)
+      return [node[1:] + c  for c in ALPHA if self.has_node(node[1:] + c)]
+
+class PackedDBG(DBG):
+  """A De Bruijn graph that stores each node and edge as its kmer packed
+     into an int (within a uint64, as edges are at most 32 bases), rather
+     than as a string. An edge's colour and strands are packed into a single
+     int (colour << STRAND_BITS | strands), shared by all edges with the same value,
+     and its frequency is only stored if it is above 1.
+
+     The string API (add_edge, has_node, has_edge, get_adjacent,
+     stranded_edges) is unchanged, and unpacked() exports the graph as a DBG
+     of strings. render() and compress() work on the unpacked graph."""
+
+  def __init__(self, k, canonical=False, track_unitigs=False):
+    if int(k) + 1 > MAX_PACKED_K:
+      raise Exception(f'k {k} is too large for packed edges of at most {MAX_PACKED_K} bases')
+    DBG.__init__(self, k, canonical, track_unitigs)
+    self.freq = dict() # Frequency of edges added more than once
+    self.values = dict() # Edge values, interned
+    self.node_mask = (1 << (2 * self.k)) - 1
+
+  def add_edge(self, edge, dbs):
+    """Extends the De Bruijin graph by a single edge, OR-ing the bitmask of
+       databases containing the edge into its colour."""
+    prefix, suffix = self.get_nodes(edge)
+    self.nodes.add(self.key(prefix))
+    self.nodes.add(self.key(suffix))
+    if self.canonical:
+      self.read.add(pack(prefix))
+      self.read.add(pack(suffix))
+      canon = KmerBackend.canonical(edge)
+      key, strand = pack(canon), FORWARD if canon == edge else REVERSE
+    else:
+      key, strand = pack(edge), FORWARD
+    old = value = self.edges.get(key)
+    if value is None:
+      value = (dbs << STRAND_BITS) | strand
+    else:
+      value |= (dbs << STRAND_BITS) | strand
+      self.freq[key] = self.freq.get(key, 1) + 1
+    self.edges[key] = self.values.setdefault(value, value)
+    if self.unitigs is not None and value != old:
+      for stranded in self.stranded(key):
+        self.unitigs.add(stranded)
+
+  def key(self, seq):
+    """Returns the packed kmer that a node or edge is stored as."""
+    return pack(KmerBackend.canonical(seq) if self.canonical else seq)
+
+  def colour(self, key):
+    value = self.edges.get(key)
+    return None if value is None else value >> STRAND_BITS
+
+  def stranded(self, key):
+    return strands(unpack(key, self.k + 1), self.edges[key] & STRAND_MASK)
+
+  def stranded_meta(self, edge):
+    key = self.key(edge)
+    if key not in self.edges or edge not in self.stranded(key):
+      return UNSEEN
+    return [self.edges[key] >> STRAND_BITS, self.freq.get(key, 1)]
+
+  def read_key(self, node):
+    return pack(node)
+
+  def state(self):
+    return self.edges, self.freq, self.read
+
+  def restore(self, state):
+    edges, self.freq, self.read = state
+    self.values = dict()
+    self.edges = {key: self.values.setdefault(value, value) for key, value in edges.items()}
+    self.nodes = set()
+    for key in self.edges:
+      for node in (key >> 2, key & self.node_mask): # Prefix and suffix
+        self.nodes.add(self.key(unpack(node, self.k)) if self.canonical else node)
+    self.restore_unitigs()
+
+  def stranded_edges(self):
+    for key, value in self.edges.items():
+      for edge in strands(unpack(key, self.k + 1), value & STRAND_MASK):
+        yield edge, [value >> STRAND_BITS, self.freq.get(key, 1)]
+
+  def unpacked(self):
+    """Returns the graph as a (single stranded) DBG of strings, with edges
+       on the strands they were added on."""
+    return self.stranded_copy()
+
+  def render(self, fname, max_nodes=-1):
+    if self.compressed:
+      DBG.render(self, fname, max_nodes)
+    else:
+      self.unpacked().render(fname, max_nodes)
+
+  def compress(self):
+    """Compresses the De Bruijn graph, replacing it by the compressed graph
+       of its unpacked strings (or of its tracked unitigs)."""
+    if self.unitigs is not None:
+      return DBG.compress(self)
+    dbg = self.unpacked()
+    dbg.compress()
+    self.nodes, self.edges = dbg.nodes, dbg.edges
+    self.canonical, self.compressed, self.read = False, True, None
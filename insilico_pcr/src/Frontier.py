@@ -0,0 +1,67 @@
+# Author: Izaak Coleman
+# email: izaak.coleman1@gmail.com
+import KmerBackend
+
+__version__ = 0.1
+
+ALPHA = 'ACGT'
+
+class Frontier:
+  """The edges that the next round of De Bruijn graph construction extends
+     from, each with its depth (the number of bases extended beyond p1*).
+
+     Each round the frontier expands into the candidate edges one base deeper.
+     Candidates are deduplicated, and candidates already in the graph with a
+     known colour (added from the query results of an earlier round) are
+     answered from the graph, so that only the remaining candidates are
+     queried. rounds records the number of candidates and of queries saved
+     in each round."""
+
+  def __init__(self):
+    self.edges = dict() # edge -> depth
+    self.depths = dict() # Candidate edge -> depth, for the current round
+    self.known = dict() # Candidate edge -> colour, of candidates answered from the graph
+    self.queries = list() # Candidates that must be queried
+    self.rounds = list() # (candidates, queries saved) per round
+
+  def expand(self, dbg, inexact):
+    """Generates the candidate edges of the next round, edge[1:] + {A, T, C, G}
+       for each edge of the frontier, and returns those that must be queried. inexact holds the
+       graph edges whose colour is not known exactly (e.g. added from probes)."""
+    self.depths, self.known = dict(), dict()
+    n_candidates = 0
+    for e, depth in self.edges.items():
+      for base in ALPHA:
+        n_candidates += 1
+        edge = e[1:] + base
+        if edge in self.depths:
+          continue
+        self.depths[edge] = depth + 1
+        key = dbg.key(edge)
+        dbs = dbg.colour(key)
+        if dbs is not None and key not in inexact:
+          self.known[edge] = dbs
+    self.queries = [edge for edge in self.depths if edge not in self.known]
+    self.rounds.append((n_candidates, n_candidates - len(self.queries)))
+    return self.queries
+
+  def answer(self, query_results):
+    """Yields a QueryHit for each candidate edge, in order, given the query
+       results of the candidates returned by expand()."""
+    query_results = iter(query_results)
+    for edge in self.depths:
+      if edge in self.known:
+        yield KmerBackend.QueryHit(edge, self.known[edge])
+      else:
+        yield next(query_results)
+
+  def extended(self, edges):
+    """Returns the candidate edges that are extended, with their depths."""
+    return {e: self.depths[e] for e in edges}
+
+  def saved(self):
+    """Returns the total number of candidates, and of queries saved."""
+    return sum(c for c, s in self.rounds), sum(s for c, s in self.rounds)
+
+  def __len__(self):
+    return len(self.edges)
@@ -0,0 +1,211 @@
+# Author: Izaak Coleman
+# email: izaak.coleman1@gmail.com
+import array
+import mmap
+import struct
+import sys
+
+import DBG
+
+__version__ = 0.1
+
+MAGIC = b'IPCRDBG\x00'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<8sIIII') # magic, version, k, compressed, number of sections
+SECTION = struct.Struct('<16sQQ') # name, offset, length (bytes)
+ALIGN = 8
+
+def hex_dbs(dbs):
+  return format(dbs, 'x')
+
+def write_gfa(dbg, fname, db_dict=None):
+  """Writes the De Bruijn graph to fname in GFA1, streaming it edge by edge.
+     An uncompressed graph is written as a segment per node and a link per
+     edge, a compressed graph as a segment per unitig and a link per edge
+     between unitigs; links overlap by k - 1 bases. Colours are written as
+     hex bitmasks of dbs in the db:Z tag, edge frequencies in fq:i and
+     unitig coverage in cv:f. db_dict, if given, is written as comment lines
+     naming the database of each bit."""
+  ids = dict() # Node -> segment name
+  with open(fname, 'w') as f:
+    f.write('H\tVN:Z:1.0\n')
+    for name, idx in sorted((db_dict or dict()).items(), key=lambda item: item[1]):
+      f.write(f'#\tdb\t{idx}\t{name}\n')
+    if dbg.compressed:
+      for unitig, (dbs, coverage) in dbg.nodes.items():
+        ids[unitig] = str(len(ids) + 1)
+        f.write(f'S\t{ids[unitig]}\t{unitig}\tLN:i:{len(unitig)}\tdb:Z:{hex_dbs(dbs)}\tcv:f:{coverage:.3f}\n')
+      edges = ((u, v, meta) for (u, v), meta in dbg.edges.items() if u != DBG.DUMMY_NODE)
+    else:
+      edges = ((edge[:dbg.k], edge[1:], meta) for edge, meta in dbg.stranded_edges())
+    for u, v, (dbs, freq) in edges:
+      for node in (u, v):
+        if node not in ids:
+          ids[node] = str(len(ids) + 1)
+          f.write(f'S\t{ids[node]}\t{node}\n')
+      f.write(f'L\t{ids[u]}\t+\t{ids[v]}\t+\t{dbg.k-1}M\tdb:Z:{hex_dbs(dbs)}\tfq:i:{freq}\n')
+
+def pack_bytes(seq):
+  """Returns seq packed 2 bits per base (see DBG.pack), in (len(seq) + 3) // 4 bytes."""
+  return DBG.pack(seq).to_bytes((len(seq) + 3) // 4, 'big')
+
+def write_binary(dbg, fname):
+  """Writes the De Bruijn graph to fname in a compact binary format that
+     load() memory maps. Sequences are packed 2 bits per base, and each
+     distinct colour is stored once. The file is a header, a table of
+     sections and the sections, each a little endian array:
+       colours, colour_ofs: the bytes of each colour, and their offsets.
+     Uncompressed graphs:
+       edge_seq: each edge, packed into (k + 4) // 4 bytes.
+     Compressed graphs:
+       node_seq, node_ofs, node_len: each unitig, packed, its offset in
+                                     node_seq and its length in bases.
+       node_col, node_cov: each unitig's colour (index) and coverage.
+       edge_u, edge_v: the unitigs (indices) each edge joins.
+     Both:
+       edge_col, edge_freq: each edge's colour (index) and frequency."""
+  colours, colour_idx = bytearray(), dict()
+  colour_ofs = array.array('Q', [0])
+  def colour(dbs):
+    if dbs not in colour_idx:
+      colour_idx[dbs] = len(colour_idx)
+      colours.extend(dbs.to_bytes((dbs.bit_length() + 7) // 8, 'little'))
+      colour_ofs.append(len(colours))
+    return colour_idx[dbs]
+
+  sections = dict()
+  edge_col, edge_freq = array.array('I'), array.array('I')
+  if dbg.compressed:
+    node_seq, node_ofs, node_len = bytearray(), array.array('Q', [0]), array.array('I')
+    node_col, node_cov, node_idx = array.array('I'), array.array('f'), dict()
+    for unitig, (dbs, coverage) in dbg.nodes.items():
+      node_idx[unitig] = len(node_idx)
+      node_seq += pack_bytes(unitig)
+      node_ofs.append(len(node_seq))
+      node_len.append(len(unitig))
+      node_col.append(colour(dbs))
+      node_cov.append(coverage)
+    edge_u, edge_v = array.array('I'), array.array('I')
+    for (u, v), (dbs, freq) in dbg.edges.items():
+      if u == DBG.DUMMY_NODE:
+        continue
+      edge_u.append(node_idx[u])
+      edge_v.append(node_idx[v])
+      edge_col.append(colour(dbs))
+      edge_freq.append(freq)
+    sections.update(node_seq=node_seq, node_ofs=node_ofs, node_len=node_len, node_col=node_col,
+                    node_cov=node_cov, edge_u=edge_u, edge_v=edge_v)
+  else:
+    edge_seq = bytearray()
+    for edge, (dbs, freq) in dbg.stranded_edges():
+      edge_seq += pack_bytes(edge)
+      edge_col.append(colour(dbs))
+      edge_freq.append(freq)
+    sections.update(edge_seq=edge_seq)
+  sections.update(edge_col=edge_col, edge_freq=edge_freq, colours=colours, colour_ofs=colour_ofs)
+  if sys.byteorder == 'big':
+    for data in sections.values():
+      if isinstance(data, array.array):
+        data.byteswap()
+
+  with open(fname, 'wb') as f:
+    f.write(HEADER.pack(MAGIC, FORMAT_VERSION, dbg.k, int(dbg.compressed), len(sections)))
+    offset = HEADER.size + SECTION.size * len(sections)
+    table = list()
+    for name, data in sections.items():
+      offset += -offset % ALIGN
+      table.append((name, offset, len(memoryview(data).cast('B'))))
+      offset += table[-1][2]
+    for name, offset, length in table:
+      f.write(SECTION.pack(name.encode(), offset, length))
+    for (name, offset, length), data in zip(table, sections.values()):
+      f.write(b'\x00' * (offset - f.tell()))
+      f.write(memoryview(data).cast('B'))
+
+class MappedGraph:
+  """A De Bruijn graph written by write_binary(), memory mapped rather than
+     read: edges and nodes are decoded as they are accessed."""
+
+  def __init__(self, fname):
+    if sys.byteorder == 'big':
+      raise Exception('Memory mapped graphs are little endian, and can not be mapped on this host')
+    self.file = open(fname, 'rb')
+    self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, self.k, compressed, n_sections = HEADER.unpack_from(self.map, 0)
+    if magic != MAGIC or version != FORMAT_VERSION:
+      raise Exception(f'{fname} is not a De Bruijn graph of binary format version {FORMAT_VERSION}')
+    self.compressed = bool(compressed)
+    self.view, self.sections = memoryview(self.map), dict()
+    for i in range(0, n_sections):
+      name, offset, length = SECTION.unpack_from(self.map, HEADER.size + i * SECTION.size)
+      self.sections[name.rstrip(b'\x00').decode()] = self.view[offset:offset + length]
+    for name, typecode in (('colour_ofs', 'Q'), ('edge_col', 'I'), ('edge_freq', 'I'), ('node_ofs', 'Q'),
+                           ('node_len', 'I'), ('node_col', 'I'), ('node_cov', 'f'), ('edge_u', 'I'),
+                           ('edge_v', 'I')):
+      if name in self.sections:
+        self.sections[name] = self.sections[name].cast(typecode)
+    self.n_edges = len(self.sections['edge_col'])
+    self.n_nodes = len(self.sections['node_len']) if self.compressed else None
+    self.edge_bytes = (self.k + 4) // 4
+
+  def colour(self, i):
+    ofs = self.sections['colour_ofs']
+    return int.from_bytes(self.sections['colours'][ofs[i]:ofs[i+1]], 'little')
+
+  def node(self, i):
+    """Returns the i'th unitig of a compressed graph, and its [bitmask of dbs, coverage]."""
+    s = self.sections
+    seq = DBG.unpack(int.from_bytes(s['node_seq'][s['node_ofs'][i]:s['node_ofs'][i+1]], 'big'), s['node_len'][i])
+    return seq, [self.colour(s['node_col'][i]), s['node_cov'][i]]
+
+  def nodes(self):
+    for i in range(0, self.n_nodes):
+      yield self.node(i)
+
+  def edge(self, i):
+    """Returns the i'th edge, and its [bitmask of dbs, frequency]. Edges of a
+       compressed graph are the pair of unitigs they join."""
+    s = self.sections
+    meta = [self.colour(s['edge_col'][i]), s['edge_freq'][i]]
+    if self.compressed:
+      return (self.node(s['edge_u'][i])[0], self.node(s['edge_v'][i])[0]), meta
+    packed = s['edge_seq'][i * self.edge_bytes:(i + 1) * self.edge_bytes]
+    return DBG.unpack(int.from_bytes(packed, 'big'), self.k + 1), meta
+
+  def edges(self):
+    for i in range(0, self.n_edges):
+      yield self.edge(i)
+
+  def dbg(self):
+    """Returns the graph read into a (single stranded) DBG."""
+    dbg = DBG.DBG(self.k)
+    if self.compressed:
+      dbg.compressed = True
+      dbg.nodes, dbg.edges = dict(self.nodes()), dict(self.edges())
+      for unitig in dbg.nodes.keys() - {n for edge in dbg.edges for n in edge}:
+        dbg.edges[(DBG.DUMMY_NODE, unitig)] = list(DBG.UNSEEN)
+    else:
+      for edge, meta in self.edges():
+        prefix, suffix = dbg.get_nodes(edge)
+        dbg.nodes.add(prefix)
+        dbg.nodes.add(suffix)
+        dbg.edges[edge] = meta
+    return dbg
+
+  def close(self):
+    for name in list(self.sections):
+      self.sections[name].release()
+    self.sections = dict()
+    self.view.release()
+    self.map.close()
+    self.file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+def load(fname):
+  """Memory maps a De Bruijn graph written by write_binary()."""
+  return MappedGraph(fname)
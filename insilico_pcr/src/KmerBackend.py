@@ -0,0 +1,86 @@
+# Author: Izaak Coleman
+# email: izaak.coleman1@gmail.com
+import collections
+
+__version__ = 0.1
+
+# A query string and the bitmask of the databases it exactly matches
+# (bit i set <=> database with index i in db_dict contains every kmer
+# of the query).
+QueryHit = collections.namedtuple('QueryHit', ['query', 'dbs'])
+
+COMPLEMENT = str.maketrans('ACGT', 'TGCA')
+
+def reverse_complement(seq):
+  return seq.translate(COMPLEMENT)[::-1]
+
+def canonical(seq):
+  """Returns the lexicographically smaller of seq and its reverse complement,
+     which represents both strands of seq."""
+  rc = reverse_complement(seq)
+  return rc if rc < seq else seq
+
+class KmerBackend:
+  """Interface that iPCR uses to query kmer membership in a set of sequence
+     databases.
+
+     A backend answers a batch of query strings with one QueryHit per query,
+     recording which databases contain every kmer of the query. db_dict maps
+     each database name to its bit in QueryHit.dbs. Implementations are
+     QueryMantis (and MantisPool, CachedQuery, CanonicalQuery, which wrap
+     it) and the in-process NumpyBackend."""
+
+  db_dict = dict()
+  mantis_q_time = 0.0 # Seconds spent waiting for the index to answer queries
+  # (kmer size, canonical) that the answers depend on, if the backend builds
+  # its own kmers; None if they are fixed by the index (e.g. Mantis)
+  kmer_params = None
+
+  def iter_query(self, q_list):
+    """Yields a QueryHit for each query in q_list, in order."""
+    raise NotImplementedError
+
+  def query(self, q_list):
+    """Returns a list of QueryHits, one per query in q_list."""
+    return list(self.iter_query(q_list))
+
+  def terminate(self):
+    """Releases the backend's resources (processes, files)."""
+    pass
+
+class CanonicalQuery(KmerBackend):
+  """Canonicalises and deduplicates each batch of queries before passing it
+     on to the wrapped querier, so that a query and its reverse complement
+     (or a query repeated in the batch) are only queried once.
+
+     Only valid for a querier whose index is canonical (e.g. Mantis, or a
+     NumpyBackend built with canonical kmers), where a query and its reverse
+     complement exactly match the same databases."""
+
+  def __init__(self, querier):
+    self.querier = querier
+    self.db_dict = querier.db_dict
+
+  @property
+  def mantis_q_time(self):
+    return self.querier.mantis_q_time
+
+  def iter_query(self, q_list):
+    """Yields a QueryHit for each query in q_list, in order."""
+    canon = [canonical(q) for q in q_list]
+    unique = list(dict.fromkeys(canon))
+    # The unique queries are in order of first occurrence, so the results
+    # needed by each query have been read by the time it is reached.
+    results, dbs = iter(self.querier.iter_query(unique) if unique else ()), dict()
+    try:
+      for q, c in zip(q_list, canon):
+        while c not in dbs:
+          hit = next(results)
+          dbs[hit.query] = hit.dbs
+        yield QueryHit(q, dbs[c])
+    finally:
+      for hit in results: # Read the querier to completion
+        pass
+
+  def terminate(self):
+    self.querier.terminate()
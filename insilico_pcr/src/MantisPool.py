@@ -0,0 +1,82 @@
+# Author: Izaak Coleman
+# email: izaak.coleman1@gmail.com
+import os
+import time
+import concurrent.futures
+
+import QueryMantis
+import KmerBackend
+
+__version__ = 0.1
+
+MIN_SHARD_SIZE = 256 # Batches smaller than this are not worth splitting
+MAX_RETRIES = 1 # Times a failed worker is respawned to retry its shard
+
+def index_size(mantis_ds):
+  """Returns the size in bytes of the files of a Mantis data structure,
+     an estimate of the memory each Mantis process needs to load it."""
+  return sum(os.path.getsize(os.path.join(mantis_ds, f)) for f in os.listdir(mantis_ds)
+             if os.path.isfile(os.path.join(mantis_ds, f)))
+
+class MantisPool(KmerBackend.KmerBackend):
+  """Runs a pool of Mantis processes (QueryMantis workers) over the same Mantis
+     data structure. Each batch of queries is split into contiguous shards that
+     are queried in parallel, and the results merged back in query order.
+
+     Each worker loads its own copy of the index, so the number of workers can
+     be capped by a memory budget. A worker that fails is respawned and its
+     shard retried; the remaining workers are unaffected."""
+
+  def __init__(self, mantis_exec = str(), mantis_ds = str(), n_workers = 1, db_dict = None, max_memory = None):
+    """max_memory: bytes available for the workers' indexes, or None if unlimited."""
+    self.mantis_exec = mantis_exec
+    self.mantis_ds = mantis_ds
+    self.db_dict = QueryMantis.load_db_dict(mantis_ds) if db_dict is None else db_dict
+    if max_memory is not None:
+      n_workers = min(n_workers, max(1, int(max_memory // max(1, index_size(mantis_ds)))))
+    self.workers = [self.spawn_worker() for i in range(0, n_workers)]
+    self.executor = concurrent.futures.ThreadPoolExecutor(n_workers)
+    self.mantis_q_time = 0.0 # Wall-clock seconds spent waiting for the workers' shards
+
+  def spawn_worker(self):
+    query_file, result_file = QueryMantis.generate_filenames()
+    return QueryMantis.QueryMantis(self.mantis_exec, self.mantis_ds, query_file, result_file, self.db_dict)
+
+  def query_shard(self, i, shard):
+    """Queries a shard on worker i, respawning the worker and retrying if it fails."""
+    for attempt in range(0, MAX_RETRIES + 1):
+      try:
+        return self.workers[i].query(shard)
+      except Exception as e:
+        print(f'Mantis worker {i} failed: {e}')
+        self.workers[i].terminate()
+        if attempt == MAX_RETRIES:
+          raise
+        self.workers[i] = self.spawn_worker()
+
+  def iter_query(self, q_list):
+    """Yields a QueryHit for each query in q_list, in order. Results of the
+       first shard are yielded while later shards are still being queried."""
+    if len(q_list) == 0:
+      return
+    n_shards = max(1, min(len(self.workers), len(q_list) // MIN_SHARD_SIZE))
+    shard_size = -(-len(q_list) // n_shards)
+    futures = [self.executor.submit(self.query_shard, i, q_list[i * shard_size:(i + 1) * shard_size])
+               for i in range(0, n_shards)]
+    # The wait is timed here rather than summed over the workers, whose waits
+    # overlap (and restart from 0 when a worker is respawned)
+    try:
+      for future in futures:
+        start = time.perf_counter()
+        shard = future.result()
+        self.mantis_q_time += time.perf_counter() - start
+        yield from shard
+    finally:
+      start = time.perf_counter()
+      concurrent.futures.wait(futures) # Workers must be idle before the next batch
+      self.mantis_q_time += time.perf_counter() - start
+
+  def terminate(self):
+    for worker in self.workers:
+      worker.terminate()
+    self.executor.shutdown()
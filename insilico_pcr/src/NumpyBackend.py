@@ -0,0 +1,124 @@
+# Author: Izaak Coleman
+# email: izaak.coleman1@gmail.com
+import gzip
+import os
+import time
+
+import numpy as np
+
+import KmerBackend
+
+__version__ = 0.1
+
+MAX_K = 32 # Largest k whose 2-bit packed kmers fit in a uint64
+SEQ_EXTS = ('.fa', '.fasta', '.fna', '.concat')
+INVALID = 4 # 2-bit code of any non-ACGT character
+
+# Maps an ASCII byte to its 2-bit code (A=0, C=1, G=2, T=3), INVALID otherwise
+CODES = np.full(256, INVALID, dtype=np.uint8)
+for code, base in enumerate('ACGT'):
+  CODES[ord(base)] = CODES[ord(base.lower())] = code
+
+def encode(seq):
+  """Returns the array of 2-bit codes of a sequence (str or bytes)."""
+  if isinstance(seq, str):
+    seq = seq.encode('ascii')
+  return CODES[np.frombuffer(seq, dtype=np.uint8)]
+
+def pack_kmers(codes, k, canonical=True):
+  """Returns, for each window of length k in the code array codes, the kmer
+     packed into a uint64 (first base in the most significant bits), and a
+     boolean array marking the windows that contain only ACGT. If canonical,
+     the smaller of each kmer and its reverse complement is returned."""
+  n = len(codes) - k + 1
+  if n <= 0:
+    return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=bool)
+  invalid = np.concatenate(([0], np.cumsum(codes == INVALID)))
+  valid = (invalid[k:] - invalid[:n]) == 0
+  bits = np.where(codes == INVALID, 0, codes).astype(np.uint64)
+  fwd = np.zeros(n, dtype=np.uint64)
+  for j in range(0, k):
+    fwd = (fwd << np.uint64(2)) | bits[j:j + n]
+  if not canonical:
+    return fwd, valid
+  rev = np.zeros(n, dtype=np.uint64)
+  for j in range(0, k):
+    rev |= (np.uint64(3) - bits[j:j + n]) << np.uint64(2 * j)
+  return np.minimum(fwd, rev), valid
+
+def read_sequences(fname):
+  """Yields the sequences of a (optionally gzipped) FASTA file, or the single
+     sequence of a .concat strain file, as bytes."""
+  opener = gzip.open if fname.endswith('.gz') else open
+  with opener(fname, 'rb') as f:
+    data = f.read()
+  if not data.startswith(b'>'):
+    yield data.replace(b'\n', b'').replace(b'\r', b'')
+    return
+  for record in data[1:].split(b'\n>'):
+    yield b''.join(record.split(b'\n')[1:]).replace(b'\r', b'')
+
+def sequence_files(path):
+  """Returns the sorted FASTA/.concat files (optionally gzipped) in a directory."""
+  return sorted(os.path.join(path, f) for f in os.listdir(path)
+                if f[:-3 if f.endswith('.gz') else None].endswith(SEQ_EXTS))
+
+class NumpyBackend(KmerBackend.KmerBackend):
+  """In-process kmer membership backend.
+
+     The kmers of each database (a FASTA or .concat strain file) are loaded
+     into a sorted array of 2-bit packed uint64 kmers. A batch of queries is
+     answered by packing all of the queries' kmers into one array and looking
+     them up in each database with a vectorised np.searchsorted. As with
+     Mantis, a query exactly matches a database if the database contains all
+     of its kmers, and kmers are canonical by default."""
+
+  def __init__(self, files, k, canonical=True, db_names=None):
+    """files: FASTA/.concat files, one per database. k: kmer size (<= 32).
+       db_names: database names, the file basenames by default."""
+    if k > MAX_K:
+      raise Exception(f'k {k} is too large for 2-bit packed uint64 kmers (max {MAX_K})')
+    self.k, self.canonical = k, canonical
+    self.kmer_params = (k, canonical)
+    names = db_names if db_names is not None else [os.path.basename(f) for f in files]
+    self.db_dict = {name:idx for idx, name in enumerate(names)}
+    self.db_kmers = [self.load_kmers(f) for f in files]
+
+  def load_kmers(self, fname):
+    """Returns the sorted array of unique packed kmers in a sequence file."""
+    kmers = list()
+    for seq in read_sequences(fname):
+      packed, valid = pack_kmers(encode(seq), self.k, self.canonical)
+      kmers.append(packed[valid])
+    return np.unique(np.concatenate(kmers)) if kmers else np.zeros(0, dtype=np.uint64)
+
+  def iter_query(self, q_list):
+    """Yields a QueryHit for each query in q_list, in order."""
+    if len(q_list) == 0:
+      return
+    start = time.perf_counter()
+    # Pack the kmers of all queries at once. Queries are separated by an
+    # invalid character so that no valid window spans two queries.
+    lengths = np.array([len(q) for q in q_list])
+    num_kmers = np.maximum(lengths - self.k + 1, 0)
+    starts = np.concatenate(([0], np.cumsum(lengths + 1)[:-1]))
+    packed, valid = pack_kmers(encode('N'.join(q_list)), self.k, self.canonical)
+    windows = np.concatenate([np.arange(s, s + n) for s, n in zip(starts, num_kmers)]).astype(np.int64)
+    kmers, valid = packed[windows], valid[windows]
+    # Queries with kmers, and the offset of each of their first kmer in kmers
+    has_kmers = num_kmers > 0
+    offsets = np.concatenate(([0], np.cumsum(num_kmers)[:-1]))[has_kmers]
+
+    dbs = [0] * len(q_list)
+    for idx, db_kmers in enumerate(self.db_kmers):
+      if len(db_kmers) == 0 or len(kmers) == 0:
+        continue
+      pos = np.minimum(np.searchsorted(db_kmers, kmers), len(db_kmers) - 1)
+      found = (db_kmers[pos] == kmers) & valid
+      exact = np.zeros(len(q_list), dtype=bool)
+      exact[has_kmers] = np.logical_and.reduceat(found, offsets)
+      for q in np.flatnonzero(exact):
+        dbs[q] |= 1 << idx
+    self.mantis_q_time += time.perf_counter() - start
+    for q, q_dbs in zip(q_list, dbs):
+      yield KmerBackend.QueryHit(q, q_dbs)
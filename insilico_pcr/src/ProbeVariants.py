@@ -0,0 +1,63 @@
+# Author: Izaak Coleman
+# email: izaak.coleman1@gmail.com
+import itertools
+
+__version__ = 0.1
+
+ALPHA = 'ACGT'
+
+def hamming_neighbourhood(probe, max_dist):
+  """Yields every sequence within Hamming distance max_dist of probe exactly
+     once, in order of increasing distance (probe itself first).
+
+     Each variant at distance d is generated from a unique choice of d
+     positions and, at each, one of the three bases that differ from the
+     probe's, so no variant is generated twice."""
+  for dist in range(0, min(max_dist, len(probe)) + 1):
+    for positions in itertools.combinations(range(0, len(probe)), dist):
+      alternatives = [[b for b in ALPHA if b != probe[i]] for i in positions]
+      for bases in itertools.product(*alternatives):
+        variant = list(probe)
+        for i, b in zip(positions, bases):
+          variant[i] = b
+        yield ''.join(variant)
+
+def edit_neighbourhood(probe, max_dist):
+  """Yields every sequence within edit distance max_dist of probe (allowing
+     substitutions, insertions and deletions) exactly once, in order of
+     increasing distance.
+
+     Unlike Hamming variants, different edit scripts frequently produce the
+     same sequence, so the variants generated so far are remembered."""
+  seen = set([probe])
+  level = [probe]
+  yield probe
+  for dist in range(0, max_dist):
+    next_level = list()
+    for seq in level:
+      for variant in single_edits(seq):
+        if variant not in seen:
+          seen.add(variant)
+          next_level.append(variant)
+          yield variant
+    level = next_level
+
+def single_edits(seq):
+  """Yields the sequences one substitution, insertion or deletion from seq
+     (possibly with repeats)."""
+  for i in range(0, len(seq) + 1):
+    for b in ALPHA:
+      yield seq[:i] + b + seq[i:] # insertion
+    if i < len(seq):
+      yield seq[:i] + seq[i+1:] # deletion
+      for b in ALPHA:
+        if b != seq[i]:
+          yield seq[:i] + b + seq[i+1:] # substitution
+
+def batches(iterable, size):
+  """Splits an iterable into lists of at most size items."""
+  iterator = iter(iterable)
+  batch = list(itertools.islice(iterator, size))
+  while batch:
+    yield batch
+    batch = list(itertools.islice(iterator, size))
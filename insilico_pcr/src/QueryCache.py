@@ -0,0 +1,160 @@
+# Author: Izaak Coleman
+# email: izaak.coleman1@gmail.com
+import collections
+import hashlib
+import os
+import sqlite3
+
+import KmerBackend
+
+__version__ = 0.1
+
+DEFAULT_LRU_SIZE = 1 << 20
+MMAP_SIZE = 1 << 30 # Bytes of the on-disk tier sqlite may memory-map
+SQLITE_MAX_VARS = 999 # Max number of ? parameters in a single sqlite statement
+
+def index_identity(mantis_ds, kmer_params=None):
+  """Returns a digest identifying a Mantis data structure (or a directory
+     of sequence files loaded by NumpyBackend).
+
+     The digest covers the contents of sampleid.lst and the name, size and
+     modification time of every file of the index, so it changes whenever the
+     index is rebuilt or its databases change. kmer_params (the kmer size and
+     canonical flag of a backend that builds its own kmers, see
+     KmerBackend.kmer_params) are covered too, if supplied."""
+  h = hashlib.sha1()
+  if kmer_params is not None:
+    h.update(f'kmer_params\t{kmer_params}\n'.encode('utf-8'))
+  if os.path.isfile(os.path.join(mantis_ds, 'sampleid.lst')):
+    with open(os.path.join(mantis_ds, 'sampleid.lst'), 'rb') as f:
+      h.update(f.read())
+  for fname in sorted(os.listdir(mantis_ds)):
+    st = os.stat(os.path.join(mantis_ds, fname))
+    h.update(f'{fname}\t{st.st_size}\t{st.st_mtime_ns}\n'.encode('utf-8'))
+  return h.hexdigest()
+
+def encode_dbs(dbs):
+  return dbs.to_bytes((dbs.bit_length() + 7) // 8, 'little')
+
+def decode_dbs(blob):
+  return int.from_bytes(blob, 'little')
+
+class QueryCache:
+  """Caches the bitmask of databases exactly matching each queried string for
+     a single Mantis data structure.
+
+     Lookups hit an in-memory LRU tier first, then an on-disk tier (a sqlite
+     file, read through a memory map) that persists between runs. The on-disk
+     tier is tagged with the identity of the Mantis data structure and is
+     emptied if the data structure has changed since it was written.
+
+     For Mantis, whether a string exactly matches a database depends only on
+     the string and the index, whose kmer size is fixed when it is built. A
+     backend that builds its own kmers (NumpyBackend) answers differently for
+     each kmer size and canonical flag, so these (kmer_params) are part of
+     the identity."""
+
+  def __init__(self, mantis_ds, cache_file, kmer_params=None, lru_size = DEFAULT_LRU_SIZE):
+    self.lru = collections.OrderedDict()
+    self.lru_size = lru_size
+    self.mem_hits, self.disk_hits, self.misses = 0, 0, 0
+    self.identity = index_identity(mantis_ds, kmer_params)
+    self.db = sqlite3.connect(cache_file)
+    self.db.execute(f'PRAGMA mmap_size = {MMAP_SIZE}')
+    self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+    self.db.execute('CREATE TABLE IF NOT EXISTS hits (query TEXT PRIMARY KEY, dbs BLOB) WITHOUT ROWID')
+    row = self.db.execute("SELECT value FROM meta WHERE key = 'identity'").fetchone()
+    if row is None or row[0] != self.identity:
+      # Index is new or has changed: all cached hits are invalid
+      self.db.execute('DELETE FROM hits')
+      self.db.execute("INSERT OR REPLACE INTO meta VALUES ('identity', ?)", (self.identity,))
+    self.db.commit()
+
+  def get_many(self, q_list):
+    """Returns a list holding, for each query in q_list, its cached bitmask
+       of exactly matching databases, or None if it is not cached."""
+    dbs_list = [self.lru.get(q) for q in q_list]
+    for q, dbs in zip(q_list, dbs_list):
+      if dbs is not None:
+        self.lru.move_to_end(q)
+        self.mem_hits += 1
+
+    # Look up the remaining queries in the on-disk tier
+    missing = list({q for q, dbs in zip(q_list, dbs_list) if dbs is None})
+    on_disk = dict()
+    for i in range(0, len(missing), SQLITE_MAX_VARS):
+      chunk = missing[i:i + SQLITE_MAX_VARS]
+      rows = self.db.execute(f'SELECT query, dbs FROM hits WHERE query IN ({",".join("?" * len(chunk))})', chunk)
+      on_disk.update((q, decode_dbs(blob)) for q, blob in rows)
+    for i, q in enumerate(q_list):
+      if dbs_list[i] is not None:
+        continue
+      if q in on_disk:
+        dbs_list[i] = on_disk[q]
+        self.disk_hits += 1
+        self.remember(q, dbs_list[i])
+      else:
+        self.misses += 1
+    return dbs_list
+
+  def put_many(self, hits):
+    """Caches a list of QueryHits in both tiers."""
+    for hit in hits:
+      self.remember(hit.query, hit.dbs)
+    self.db.executemany('INSERT OR REPLACE INTO hits VALUES (?, ?)',
+                        [(hit.query, encode_dbs(hit.dbs)) for hit in hits])
+    self.db.commit()
+
+  def remember(self, query, dbs):
+    """Adds a query to the in-memory LRU tier, evicting the least recently
+       used query if the tier is full."""
+    self.lru[query] = dbs
+    self.lru.move_to_end(query)
+    if len(self.lru) > self.lru_size:
+      self.lru.popitem(last=False)
+
+  def hit_rate(self):
+    lookups = self.mem_hits + self.disk_hits + self.misses
+    return (self.mem_hits + self.disk_hits) / lookups if lookups else 0.0
+
+  def summary(self):
+    return (f'query cache: {self.mem_hits} memory hits, {self.disk_hits} disk hits, '
+            f'{self.misses} misses ({100 * self.hit_rate():.1f}% hit rate)')
+
+  def close(self):
+    self.db.close()
+
+class CachedQuery(KmerBackend.KmerBackend):
+  """Answers queries from a QueryCache, passing only the cache misses on to
+     the wrapped querier (e.g. a QueryMantis instance)."""
+
+  def __init__(self, querier, cache):
+    self.querier = querier
+    self.cache = cache
+    self.db_dict = querier.db_dict
+
+  @property
+  def mantis_q_time(self):
+    return self.querier.mantis_q_time
+
+  def iter_query(self, q_list):
+    """Yields a QueryHit for each query in q_list, in order."""
+    cached = self.cache.get_many(q_list)
+    misses = [q for q, dbs in zip(q_list, cached) if dbs is None]
+    fresh, new_hits = iter(self.querier.iter_query(misses) if misses else ()), list()
+    try:
+      for q, dbs in zip(q_list, cached):
+        if dbs is None:
+          hit = next(fresh)
+          new_hits.append(hit)
+          yield hit
+        else:
+          yield KmerBackend.QueryHit(q, dbs)
+    finally:
+      for hit in fresh: # Read the querier to completion, so all misses are cached
+        new_hits.append(hit)
+      self.cache.put_many(new_hits)
+
+  def terminate(self):
+    self.cache.close()
+    self.querier.terminate()
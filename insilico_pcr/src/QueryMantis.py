@@ -1,88 +1,195 @@
 # Author: Izaak Coleman
 # email: izaak.coleman1@gmail.com
 import subprocess
-import json
 import os
-import timeit
-import re
-import collections
-import sys
-import psutil
+import codecs
 import time
+import re
+import select
+import random
+import string
+
+import KmerBackend
 
 __version__ = 0.1
 
-ILLEGAL_REGEX_1 = r'{(\n,)+'
-ILLEGAL_REGEX_2 = r'([0-9]),\n}'
+# Tokens of Mantis' json output: punctuation, strings, numbers and anything
+# else (which is illegal). Commas are matched but never emitted, see tokenize()
+TOKEN_REGEX = re.compile(r'([{}\[\]:,])|"((?:[^"\\]|\\.)*)"|(-?[0-9][0-9.eE+-]*)|(\S)')
+STRING, NUMBER = '"', '0'
 QUERY = b'Q'
 TERM = b'T'
+READ_SIZE = 1 << 16
 
-def has_handle(fpath):
-  for proc in psutil.process_iter():
-    try:
-      for item in proc.open_files():
-        if fpath == item.path:
-          return True
-    except Exception:
-      pass
-  return False
-
-class QueryResult(collections.UserDict):
-  """Stores the Mantis json object as a dictionary, and adds to the
-     dictionary a query key value pair. """
-  def __init__(self, query_dict, query_string):
-    self.data = query_dict 
-    self['query'] = query_string
-
-  
- 
-class QueryMantis:
-  """Queries a Mantis data structure given a set of queries and parses into an
-     object-based format. """
-
-  def __init__(self, mantis_exec = str(), mantis_ds = str(), query_file = str(), result_file = str()):
-    """Set the path to the the mantis executable and mantis data structure."""
+def tokenize(chunks):
+  """Splits a stream of Mantis json text chunks into (kind, value) tokens,
+     where kind is the punctuation character, STRING or NUMBER. 
+
+     Mantis' json output is syntactically illegal with respect to python's
+     json library: when a query is not hit, the database list under ['res']
+     contains stray commas, and the last database is followed by a trailing
+     comma. Commas carry no information that the {, }, [, ] and : tokens do
+     not, so they are dropped here, which makes the illegal synatix harmless.
+     Each chunk is only tokenized up to its last newline so that no token is
+     split between two chunks."""
+  tail = str()
+  for chunk in chunks:
+    text = tail + chunk
+    cut = text.rfind('\n') + 1
+    text, tail = text[:cut], text[cut:]
+    yield from _tokenize_text(text)
+  yield from _tokenize_text(tail)
+
+def _tokenize_text(text):
+  for punct, string_val, number_val, illegal in TOKEN_REGEX.findall(text):
+    if punct == ',':
+      continue
+    elif punct:
+      yield punct, None
+    elif number_val:
+      yield NUMBER, float(number_val) if any(c in number_val for c in '.eE') else int(number_val)
+    elif illegal:
+      raise Exception(f'Illegal character {illegal} in Mantis results')
+    else:
+      yield STRING, string_val
+
+def parse_value(token, tokens):
+  """Parses the json value beginning with token, consuming the rest of the
+     value from the token iterator tokens."""
+  kind, value = token
+  if kind == STRING or kind == NUMBER:
+    return value
+  elif kind == '{':
+    obj = dict()
+    for kind, key in tokens:
+      if kind == '}':
+        return obj
+      if kind != STRING or next(tokens, (None,))[0] != ':':
+        raise Exception('Malformed object in Mantis results')
+      obj[key] = parse_value(next(tokens, (None, None)), tokens)
+  elif kind == '[':
+    arr = list()
+    for token in tokens:
+      if token[0] == ']':
+        return arr
+      arr.append(parse_value(token, tokens))
+  else:
+    raise Exception(f'Unexpected token {kind} in Mantis results')
+  raise Exception('Mantis results ended unexpectedly')
+
+def parse_results(chunks):
+  """Incrementally parses the Mantis json output streamed as text chunks,
+     yielding the json object of each query as soon as it is complete."""
+  tokens = tokenize(chunks)
+  if next(tokens, (None,))[0] != '[':
+    raise Exception('Mantis results are empty or do not begin with [')
+  for token in tokens:
+    if token[0] == ']':
+      return
+    yield parse_value(token, tokens)
+  raise Exception('Mantis results ended unexpectedly')
+
+QueryHit = KmerBackend.QueryHit
+
+def generate_filenames():
+  """Generates a unique pair of filenames for mantis query file and mantis results file
+     used by QueryMantis."""
+  alphanums = string.ascii_uppercase + string.digits
+  query_file = ''.join([random.choice(alphanums) for i in range(0, 15)]) + '.query_file'
+  result_file = ''.join([random.choice(alphanums) for i in range(0, 15)]) + '.mantis.json'
+  while (query_file[:15] == result_file[:15] or 
+         os.path.isfile(query_file) or 
+         os.path.lexists(result_file)):
+    query_file = ''.join([random.choice(alphanums) for i in range(0, 15)]) + '.query_file'
+    result_file = ''.join([random.choice(alphanums) for i in range(0, 15)]) + '.mantis.json'
+  return query_file, result_file
+
+def load_db_dict(mantis_ds):
+  """Maps each database name listed in the Mantis data structure's 
+     sampleid.lst to its index."""
+  with open(os.path.join(mantis_ds, 'sampleid.lst')) as f:
+    dbs = [l.strip().split()[1] for l in f]
+  return {db:idx for idx, db in enumerate(dbs)}
+
+def decode_hits(json_obj, db_dict):
+  """Decodes the Mantis json object of a query into the bitmask of databases
+     that exactly match the query (contain all of its kmers)."""
+  num_kmers, dbs = json_obj['num_kmers'], 0
+  for db, num_kmers_in_db in json_obj['res'].items():
+    if num_kmers_in_db == num_kmers:
+      dbs |= 1 << db_dict[db]
+  return dbs
+
+class QueryMantis(KmerBackend.KmerBackend):
+  """Queries a Mantis data structure given a set of queries and decodes the
+     results into QueryHits. """
+
+  def __init__(self, mantis_exec = str(), mantis_ds = str(), query_file = str(), result_file = str(), db_dict = None):
+    """Set the path to the the mantis executable and mantis data structure.
+       db_dict maps database names to their bit in QueryHit.dbs, and is read
+       from the data structure's sampleid.lst if not supplied."""
     self.mantis_exec = mantis_exec
     self.mantis_ds = mantis_ds
     self.query_file = query_file
     self.result_file = result_file
-    self.mantis_q_time = 0.0
+    self.mantis_q_time = 0.0 # Seconds spent waiting for Mantis' results
     if os.path.isfile(mantis_exec) == False or os.path.isdir(mantis_ds) == False:
       raise Exception("Either the supplied mantis executable path or mantis data structure path does not exist")
-    self.complement = {'A':'T', 'C':'G', 'G':'C', 'T':'A'}
+    self.db_dict = load_db_dict(mantis_ds) if db_dict is None else db_dict
 
     # Create query file (empty) to pass mantis is_file checks
     open(query_file,'w').close()
+    # The result file is a named pipe. Mantis blocks opening it until we are
+    # reading, and closing its end (EOF) signals that the batch is complete,
+    # so no polling of the filesystem is needed to detect completion.
+    if os.path.lexists(result_file):
+      os.remove(result_file)
+    os.mkfifo(result_file)
     cmd = f'{self.mantis_exec} query -1 -j -p {self.mantis_ds} -o {self.result_file} {self.query_file}'
     self.mantis_proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stdin=subprocess.PIPE, shell=True)
     result = self.mantis_proc.stdout.readline()
     print(result)
     
 
-  def parse_result_file(self):
-    """Parse Mantis output json into a json object. 
-    
-       Mantis' json output is syntactically illegal with respect to 
-       python's json library, specifically, when the query is not hit, 
-       the database list under ['res'] has illegal synatix. The illegal
-       synatix is replaced with appropriate synatix.  """
-    q_results = str()
-    with open(self.result_file, 'r') as f:
-      q_results = f.read()
-      q_results = re.sub(ILLEGAL_REGEX_1, '{', q_results)
-      q_results = re.sub(ILLEGAL_REGEX_2, r'\1}', q_results)
+  def iter_result_chunks(self):
+    """Blocks until Mantis writes the results of the last query to the
+       result pipe, and yields them chunk by chunk as they arrive. 
+
+       EOF on the pipe (Mantis closing its end) marks completion of the batch. 
+       Mantis' stdout is watched alongside the pipe, as EOF on stdout means
+       the Mantis process has died and no results will arrive."""
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    result_fd = os.open(self.result_file, os.O_RDONLY | os.O_NONBLOCK)
+    stdout_fd = self.mantis_proc.stdout.fileno()
+    poller = select.poll()
+    poller.register(result_fd, select.POLLIN)
+    poller.register(stdout_fd, select.POLLIN)
     try:
-      return json.loads(q_results)
-    except:
-      with open(self.result_file, 'r') as f:
-        print('file is empty')
-        print(f.read())
-        self.terminate()
-        sys.exit()
+      while True:
+        start = time.perf_counter()
+        events = poller.poll()
+        self.mantis_q_time += time.perf_counter() - start
+        for fd, event in events:
+          if fd == result_fd:
+            chunk = os.read(result_fd, READ_SIZE)
+            if not chunk: # Mantis closed the pipe, results complete
+              yield decoder.decode(b'', final=True)
+              return
+            yield decoder.decode(chunk)
+          elif not os.read(stdout_fd, READ_SIZE): 
+            raise Exception('Mantis process exited before returning query results.')
+    finally:
+      os.close(result_fd)
 
-  def query(self, q_list):
-    """Queries query list q_list against a Mantis data structure and returns
-       an object containing the query results."""
+  def iter_query(self, q_list):
+    """Queries query list q_list against a Mantis data structure, yielding 
+       a QueryHit for each query, in order, as Mantis' results are parsed.
+       
+       The results are always read to completion (even if the caller stops
+       iterating early) so that Mantis is ready for the next query."""
+    # A round may have no queries (e.g. all were answered from the graph)
+    if len(q_list) == 0:
+      return
 
     # Write queries to query file. Use random string for query filename
     # in case multiple jobs run in parallel
@@ -90,23 +197,23 @@ class QueryMantis:
       f.write('\n'.join(q_list))
 
     # Run mantis query
-    start = timeit.timeit()
     self.mantis_proc.stdin.write(QUERY)
     self.mantis_proc.stdin.flush()
-
-    while os.path.isfile(self.result_file) == False or has_handle(self.result_file) == True:
-      pass
-    time.sleep(0.1)
-
-    end = timeit.timeit()
-    self.mantis_q_time += end - start
     
-    # Parse query file into a list of QueryResult objects.
+    # Parse the results streamed through the result pipe, decoding each
+    # into a QueryHit.
+    chunks = self.iter_result_chunks()
     try:
-      return [QueryResult(json_obj, query) for json_obj, query in zip(self.parse_result_file(), q_list)]
+      for json_obj, query in zip(parse_results(chunks), q_list):
+        yield QueryHit(query, decode_hits(json_obj, self.db_dict))
     except Exception as e:
       print(e)
+      chunks.close()
       self.terminate()
+      raise
+    finally:
+      for _ in chunks: # Read to completion, so Mantis is ready for the next query
+        pass
     
   def terminate(self):
     try:
@@ -114,5 +221,11 @@ class QueryMantis:
       self.mantis_proc.stdin.flush()
     except:
       pass
+    # Remove the query file and result pipe
+    for fname in (self.query_file, self.result_file):
+      try:
+        os.remove(fname)
+      except OSError:
+        pass
 
 
@@ -0,0 +1,121 @@
+# Author: Izaak Coleman
+# email: izaak.coleman1@gmail.com
+import cProfile
+import json
+import os
+import resource
+import time
+import tracemalloc
+
+__version__ = 0.1
+
+# Per round fields of the summary table, and their formats
+COLUMNS = [('round', '{:>5}'), ('frontier', '{:>8}'), ('queries', '{:>8}'), ('saved', '{:>6}'),
+           ('mantis_s', '{:>9.3f}'), ('parse_s', '{:>8.3f}'), ('update_s', '{:>9.3f}'),
+           ('nodes', '{:>8}'), ('edges', '{:>8}'), ('unitigs', '{:>8}'), ('collapsed', '{:>9}'),
+           ('rss_mb', '{:>8.1f}')]
+TIMES = ['mantis_s', 'parse_s', 'update_s']
+N_SLOWEST = 10 # Rounds listed in the summary table
+N_ALLOCATIONS = 10 # Allocation sites listed in the tracemalloc summary
+
+def rss():
+  """Returns the resident set size of this process in MB (the peak RSS if
+     the current RSS is unavailable)."""
+  try:
+    with open('/proc/self/statm') as f:
+      return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+  except (OSError, ValueError):
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+class Trace:
+  """Records statistics of each round of De Bruijn graph construction: the
+     frontier size, the number of queries (and of candidate edges answered
+     without querying), the time spent waiting for the index (Mantis'
+     latency), parsing its results and updating the graph, the size of the
+     graph (and the bubble branches collapsed so far, if collapsing) and the
+     RSS. Round 0 records the probe queries.
+
+     Each record is written to a JSONL trace file, if given, as its round
+     completes. The construction can also be profiled with cProfile (stats
+     dumped to profile_file) and its allocations traced with tracemalloc."""
+
+  def __init__(self, trace_file=None, profile_file=None, trace_malloc=False):
+    self.records = list()
+    self.trace = open(trace_file, 'w') if trace_file else None
+    self.profile_file, self.trace_malloc = profile_file, trace_malloc
+    self.profiler = None
+    self.query_time = 0.0
+    self.elapsed = 0.0
+
+  def start(self):
+    """Starts the clock, and the profiler and tracemalloc if enabled."""
+    if self.profile_file:
+      self.profiler = cProfile.Profile()
+      self.profiler.enable()
+    if self.trace_malloc:
+      tracemalloc.start()
+    self.start_time = time.perf_counter()
+
+  def finish(self):
+    """Stops the clock and the profiler, dumping its stats, and closes the trace."""
+    self.elapsed = time.perf_counter() - self.start_time
+    if self.profiler:
+      self.profiler.disable()
+      self.profiler.dump_stats(self.profile_file)
+    if self.trace:
+      self.trace.close()
+
+  def begin_round(self, qm):
+    """Starts timing a round that queries the querier qm."""
+    self.round_start = time.perf_counter()
+    self.query_time = 0.0
+    self.wait_start = qm.mantis_q_time
+
+  def timed(self, query_results):
+    """Yields the query results, adding the time spent producing them
+       (waiting for and parsing the index's results) to query_time."""
+    query_results = iter(query_results)
+    while True:
+      start = time.perf_counter()
+      try:
+        hit = next(query_results)
+      except StopIteration:
+        return
+      finally:
+        self.query_time += time.perf_counter() - start
+      yield hit
+
+  def end_round(self, qm, frontier, queries, saved, nodes, edges, unitigs=None, collapsed=None):
+    """Records a round begun by begin_round(). The time not spent producing
+       query results (see timed()) is attributed to updating the graph.
+       unitigs, the number of unitigs of the graph, and collapsed, the
+       number of bubble branches collapsed so far, are recorded if known."""
+    total = time.perf_counter() - self.round_start
+    mantis = qm.mantis_q_time - self.wait_start
+    record = dict(round=len(self.records), frontier=frontier, queries=queries, saved=saved,
+                  mantis_s=mantis, parse_s=max(0.0, self.query_time - mantis),
+                  update_s=total - self.query_time, nodes=nodes, edges=edges, rss_mb=rss())
+    if unitigs is not None:
+      record['unitigs'] = unitigs
+    if collapsed is not None:
+      record['collapsed'] = collapsed
+    self.records.append(record)
+    if self.trace:
+      self.trace.write(json.dumps(record) + '\n')
+      self.trace.flush()
+    return record
+
+  def summary(self):
+    """Returns a table of the slowest rounds and the totals over all rounds."""
+    header = ' '.join(f'{name:>{len(fmt.format(0))}}' for name, fmt in COLUMNS)
+    row = lambda r: ' '.join(fmt.format(r[name]) if name in r else ' ' * len(fmt.format(0))
+                             for name, fmt in COLUMNS)
+    slowest = sorted(self.records, key=lambda r: -sum(r[t] for t in TIMES))[:N_SLOWEST]
+    totals = {name: sum(r[name] for r in self.records) for name in ['queries', 'saved'] + TIMES}
+    lines = [f'{len(self.records)} rounds in {self.elapsed:.3f}s. Slowest rounds:', header]
+    lines += [row(r) for r in sorted(slowest, key=lambda r: r['round'])]
+    lines.append(row(totals).replace(' ' * 5, 'total', 1).rstrip())
+    if self.trace_malloc and tracemalloc.is_tracing():
+      lines.append('Top allocations:')
+      lines += [f'  {stat}' for stat in tracemalloc.take_snapshot().statistics('lineno')[:N_ALLOCATIONS]]
+    return '\n'.join(lines)
@@ -0,0 +1,140 @@
+# Author: Izaak Coleman
+# email: izaak.coleman1@gmail.com
+
+__version__ = 0.1
+
+ALPHA = 'ACGT'
+DBS = 0
+
+class Unitigs:
+  """The unitig decomposition of a (single stranded) De Bruijn graph, kept
+     up to date as edges are added, rather than computed by compression.
+
+     Nodes u, v (v following u, i.e. u[1:] == v[:-1]) are adjacent in a
+     unitig, linked u -> v, if u is the only node with its k-1 suffix and v
+     the only node with that k-1 prefix (structurally linked), unless the
+     structural link into u has a different colour (the edge u -> v starts
+     a run of a new colour). Whether u -> v is linked only depends on the
+     nodes around u and v, so each added edge is linked by updating the links
+     of a few nodes around it. A unitig is a maximal path of linked nodes; a
+     cycle of linked nodes is a unitig starting at its smallest node.
+
+     meta(edge) returns the [bitmask of dbs, frequency] of an edge of the
+     graph on the strand it was added on, or (0, 0) if it is absent."""
+
+  def __init__(self, meta):
+    self.meta = meta
+    self.nodes = set()
+    self.n_in, self.n_out = dict(), dict() # k-1 mer -> number of nodes with it as suffix (prefix)
+    self.next, self.prev = dict(), dict() # Links u -> v
+    self.cycles = 0 # Cycles of linked nodes
+
+  def __len__(self):
+    """Returns the number of unitigs."""
+    return len(self.nodes) - len(self.next) + self.cycles
+
+  def add(self, edge):
+    """Updates the decomposition for an edge added (or recoloured), on the
+       strand it was added on."""
+    prefix, suffix = edge[:-1], edge[1:]
+    new = False
+    for node in (prefix, suffix):
+      if node not in self.nodes: # Updates the links of the nodes around it, prefix and suffix among them
+        self.add_node(node)
+        new = True
+    if not new:
+      # The edge's colour decides whether it, and the link following it, cut a unitig
+      self.update(prefix)
+      self.update(suffix)
+
+  def add_node(self, node):
+    self.nodes.add(node)
+    p, s = node[:-1], node[1:]
+    self.n_out[p] = self.n_out.get(p, 0) + 1
+    self.n_in[s] = self.n_in.get(s, 0) + 1
+    # The links out of the nodes on either side of p and s
+    for overlap in (p, s):
+      for base in ALPHA:
+        for node in (base + overlap, overlap + base):
+          if node in self.nodes:
+            self.update(node)
+
+  def successor(self, node):
+    """Returns the node structurally linked from node, or None."""
+    overlap = node[1:]
+    if self.n_in.get(overlap) != 1 or self.n_out.get(overlap) != 1:
+      return None
+    for base in ALPHA:
+      if overlap + base in self.nodes:
+        return overlap + base
+
+  def predecessor(self, node):
+    """Returns the node structurally linked to node, or None."""
+    overlap = node[:-1]
+    if self.n_in.get(overlap) != 1 or self.n_out.get(overlap) != 1:
+      return None
+    for base in ALPHA:
+      if base + overlap in self.nodes:
+        return base + overlap
+
+  def update(self, u):
+    """Links u to its successor, or unlinks it, as the nodes and colours
+       around u now require."""
+    v = self.successor(u)
+    if v is not None:
+      t = self.predecessor(u)
+      if t is not None and self.meta(t + u[-1])[DBS] != self.meta(u + v[-1])[DBS]:
+        v = None
+    if self.next.get(u) == v:
+      return
+    if u in self.next:
+      self.unlink(u)
+    if v is not None:
+      self.link(u, v)
+
+  def link(self, u, v):
+    self.next[u], self.prev[v] = v, u
+    if self.in_cycle(u, v):
+      self.cycles += 1
+
+  def unlink(self, u):
+    v = self.next[u]
+    if self.in_cycle(u, v):
+      self.cycles -= 1
+    del self.next[u], self.prev[v]
+
+  def in_cycle(self, u, v):
+    """Returns whether the link u -> v is in a cycle. The links are walked
+       forward from v and backward from u at once, so that a path is only
+       walked up to its nearer end."""
+    fwd, bwd = v, u
+    while fwd is not None and bwd is not None:
+      if fwd == u or bwd == v:
+        return True
+      fwd, bwd = self.next.get(fwd), self.prev.get(bwd)
+    return False
+
+  def paths(self):
+    """Yields each unitig, as its path of nodes."""
+    visited = set() if self.cycles else None
+    for node in self.nodes:
+      if node not in self.prev:
+        path = self.walk(node)
+        if visited is not None:
+          visited.update(path)
+        yield path
+    if self.cycles: # The remaining nodes are in cycles
+      for node in self.nodes:
+        if node not in visited:
+          path = self.walk(node)
+          visited.update(path)
+          i = path.index(min(path))
+          yield path[i:] + path[:i]
+
+  def walk(self, start):
+    """Returns the path of linked nodes from start, up to its end or back to start."""
+    path, node = [start], self.next.get(start)
+    while node is not None and node != start:
+      path.append(node)
+      node = self.next.get(node)
+    return path
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# Author: Izaak Coleman
+# email: izaak.coleman1@gmail.com
+
+import sys
+import argparse
+
+import main
+import BatchPCR
+
+__version__ = 0.1
+
+def parse_args(argv):
+  parser = argparse.ArgumentParser(description='Assembles the genome between each of a list of probe pairs in one iPCR session, '
+                                               'merging the queries of all pairs into one mantis query per round.')
+  parser.add_argument('pairs', help='csv of probe pairs with columns p1, p2 and (optionally) region, '
+                                    'e.g. the output of probe_generator.py')
+  main.add_search_args(parser)
+  return parser.parse_args(argv[1:])
+
+def batch_main():
+  '''Assembles the genome between every probe pair in a list of pairs,
+     writing the De Bruijn graph and amplicons of each pair to <dbg_fname>.<region>. '''
+  args = main.check_search_args(parse_args(sys.argv))
+  pairs = list()
+  for region, p1, p2 in BatchPCR.read_pairs(args.pairs):
+    try:
+      pairs.append((region, *main.check_probes(p1, p2, args.k)))
+    except Exception as e:
+      print(f'Skipping region {region}: {e}')
+
+  trace = main.make_trace(args)
+  trace.start()
+  batch = BatchPCR.BatchPCR(pairs, args.mantis_exec, args.mantis_ds, args.max_p1_mismatch,
+                            args.max_p2_mismatch, args.k, args.max_extension, trace=trace,
+                            **main.ipcr_args(args))
+  dbgs = batch.run()
+  trace.finish()
+  if batch.cache:
+    print(batch.cache.summary())
+  for region, pcr in zip(batch.regions, batch.pcrs):
+    print(f'{region}: {pcr.report()}')
+  print(trace.summary())
+  for region, pcr in zip(batch.regions, batch.pcrs):
+    main.write_dbg(dbgs[region], f'{args.dbg_fname}.{region}', args, pcr.db_dict)
+    main.write_amplicons(pcr, dbgs[region], f'{args.dbg_fname}.{region}', args)
+
+if __name__ == '__main__':
+  batch_main()
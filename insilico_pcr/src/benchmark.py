@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# Author: Izaak Coleman
+# email: izaak.coleman1@gmail.com
+
+import sys
+import os
+import argparse
+import itertools
+import json
+import random
+import tempfile
+import time
+import contextlib
+
+import iPCR
+import KmerBackend
+import Trace
+
+__version__ = 0.1
+
+ALPHA = 'ACGT'
+# Region types, modelled on the dsgv/vsgv regions of data/struct_var
+REGIONS = ['snp', 'dsgv', 'vsgv', 'repeat', 'palindrome']
+FLANK_LEN = 200 # Conserved sequence either side of the region, holding p1 and p2
+BACKGROUND_LEN = 1000 # Unrelated sequence either side of the flanks
+
+def random_seq(n, rng):
+  return ''.join(rng.choice(ALPHA) for i in range(0, n))
+
+def add_snps(seq, density, rng):
+  """Substitutes a random base at each position of seq with probability density."""
+  return ''.join(rng.choice([b for b in ALPHA if b != c]) if rng.random() < density else c
+                 for c in seq)
+
+def region_variant(region, region_type, i, args, rng):
+  """Returns strain i's variant of the reference region, for a region type:
+       snp: independent SNPs at snp_density in every strain.
+       dsgv: a deletion of sv_len bases, present in every second strain.
+       vsgv: an insertion of sv_len novel bases, present in every second strain.
+       repeat: a tandem repeat of a repeat_unit base unit whose copy number
+               varies from 1 to max_copies between strains.
+       palindrome: an inverted repeat, a repeat_unit base unit followed by
+                   its reverse complement, so that the region holds
+                   palindromic edges (which read the same on either strand).
+     Every type also carries SNPs at snp_density."""
+  pos = len(region) // 2
+  if region_type == 'dsgv' and i % 2:
+    region = region[:pos] + region[pos + args.sv_len:]
+  elif region_type == 'vsgv' and i % 2:
+    region = region[:pos] + random_seq(args.sv_len, random.Random(args.seed)) + region[pos:]
+  elif region_type == 'repeat':
+    unit = random_seq(args.repeat_unit, random.Random(args.seed))
+    region = region[:pos] + unit * (1 + i % args.max_copies) + region[pos:]
+  elif region_type == 'palindrome':
+    unit = random_seq(args.repeat_unit, random.Random(args.seed))
+    region = region[:pos] + unit + KmerBackend.reverse_complement(unit) + region[pos:]
+  return add_snps(region, args.snp_density, rng)
+
+def make_cohort(path, region_type, n_strains, k, args):
+  """Writes the FASTA file of each of n_strains synthetic strains to path,
+     returning the probes p1, p2 flanking their variable region."""
+  rng = random.Random(f'{args.seed}:{region_type}:{n_strains}')
+  left, right = random_seq(FLANK_LEN, rng), random_seq(FLANK_LEN, rng)
+  region = random_seq(args.region_len, rng)
+  probe_len = k + args.probe_extra
+  p1, p2 = left[-probe_len:], right[:probe_len]
+  for i in range(0, n_strains):
+    seq = (random_seq(BACKGROUND_LEN, rng) + left +
+           region_variant(region, region_type, i, args, rng) +
+           right + random_seq(BACKGROUND_LEN, rng))
+    with open(os.path.join(path, f'strain_{i}.fa'), 'w') as f:
+      f.write(f'>strain_{i}\n{seq}\n')
+  return p1, p2
+
+def run_config(qm, p1, p2, k, mismatch):
+  """Runs iPCR and compresses its De Bruijn graph, returning the measurements."""
+  trace = Trace.Trace()
+  with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+    trace.start()
+    ipcr = iPCR.iPCR(p1, p2, max_p1_mismatch=mismatch, max_p2_mismatch=mismatch, k=k,
+                     max_extension=-1, qm=qm, trace=trace)
+    dbg = ipcr.run()
+    trace.finish()
+    nodes, edges = len(dbg.nodes), len(dbg.edges)
+    start = time.perf_counter()
+    dbg.compress()
+    compress_s = time.perf_counter() - start
+  queries = sum(r['queries'] for r in trace.records)
+  return dict(rounds=len(trace.records) - 1, queries=queries, wall_s=trace.elapsed,
+              queries_per_s=queries / trace.elapsed if trace.elapsed else 0.0,
+              compress_s=compress_s, nodes=nodes, edges=edges, unitigs=len(dbg.nodes),
+              reached_p2=len(ipcr.reached_p2), peak_rss_mb=max(r['rss_mb'] for r in trace.records))
+
+def benchmark(args):
+  """Yields a result (parameters and measurements) per configuration of the grid."""
+  for region_type, n_strains, k in itertools.product(args.regions, args.strains, args.k):
+    with tempfile.TemporaryDirectory() as path:
+      p1, p2 = make_cohort(path, region_type, n_strains, k, args)
+      start = time.perf_counter()
+      qm, cache = iPCR.make_querier(None, path, backend='numpy', kmer_size=k + 1)
+      load_s = time.perf_counter() - start
+      for mismatch in args.mismatches:
+        for rep in range(0, args.repeats):
+          result = dict(version=__version__, region=region_type, strains=n_strains, k=k,
+                        mismatch=mismatch, rep=rep, load_s=load_s)
+          result.update(run_config(qm, p1, p2, k, mismatch))
+          yield result
+
+def config_key(result):
+  return tuple(result[p] for p in ('region', 'strains', 'k', 'mismatch', 'rep'))
+
+def compare(results, baseline_fname, tolerance):
+  """Compares results with those of a baseline run. Returns the regressions:
+     configurations whose rounds or queries changed, or whose wall time grew
+     by more than the tolerance (a fraction of the baseline's)."""
+  with open(baseline_fname) as f:
+    baseline = {config_key(r): r for r in map(json.loads, f)}
+  regressions = list()
+  for r in results:
+    b = baseline.get(config_key(r))
+    if b is None:
+      continue
+    for field in ('rounds', 'queries'):
+      if r[field] != b[field]:
+        regressions.append(f'{config_key(r)}: {field} {b[field]} -> {r[field]}')
+    if r['wall_s'] > b['wall_s'] * (1 + tolerance):
+      regressions.append(f'{config_key(r)}: wall_s {b["wall_s"]:.3f} -> {r["wall_s"]:.3f}')
+  return regressions
+
+def int_list(s):
+  return [int(x) for x in s.split(',')]
+
+def parse_args(argv):
+  parser = argparse.ArgumentParser(description='Benchmarks iPCR on synthetic strain cohorts, using the '
+                                               'in-process numpy kmer backend in place of mantis.')
+  parser.add_argument('--regions', type=lambda s: s.split(','), default=REGIONS,
+                      help=f'comma separated region types, of {",".join(REGIONS)}')
+  parser.add_argument('--strains', type=int_list, default=[2, 8, 32], help='comma separated cohort sizes')
+  parser.add_argument('--k', type=int_list, default=[15, 21, 31], help='comma separated values of k (<= 31)')
+  parser.add_argument('--mismatches', type=int_list, default=[0, 1, 2],
+                      help='comma separated max p1 and p2 mismatches')
+  parser.add_argument('--repeats', type=int, default=1, help='runs of each configuration')
+  parser.add_argument('--region-len', type=int, default=500, help='length of the reference region')
+  parser.add_argument('--snp-density', type=float, default=0.005, help='SNPs per base of region')
+  parser.add_argument('--sv-len', type=int, default=100, help='length of dsgv deletions and vsgv insertions')
+  parser.add_argument('--repeat-unit', type=int, default=30, help='length of the repeat (and palindrome) region\'s unit')
+  parser.add_argument('--max-copies', type=int, default=4, help='max copies of the repeat region\'s unit')
+  parser.add_argument('--probe-extra', type=int, default=5, help='probes are k + probe_extra bases long')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--output', default=None, help='JSONL file to write a result per configuration to')
+  parser.add_argument('--baseline', default=None,
+                      help='JSONL output of a previous run to compare against; exits 1 on regressions')
+  parser.add_argument('--tolerance', type=float, default=0.2,
+                      help='fraction that wall time may grow beyond the baseline\'s')
+  args = parser.parse_args(argv[1:])
+  if not set(args.regions) <= set(REGIONS):
+    parser.error(f'region types must be of {",".join(REGIONS)}')
+  return args
+
+def main():
+  args = parse_args(sys.argv)
+  out = open(args.output, 'w') if args.output else None
+  results = list()
+  print('region  strains   k  mm  rounds  queries   wall_s  queries/s  compress_s  peak_rss_mb')
+  for r in benchmark(args):
+    results.append(r)
+    print(f'{r["region"]:<7} {r["strains"]:>7} {r["k"]:>3} {r["mismatch"]:>3} {r["rounds"]:>7} '
+          f'{r["queries"]:>8} {r["wall_s"]:>8.3f} {r["queries_per_s"]:>10.0f} {r["compress_s"]:>11.3f} '
+          f'{r["peak_rss_mb"]:>12.1f}')
+    if out:
+      out.write(json.dumps(r) + '\n')
+      out.flush()
+  if out:
+    out.close()
+  if args.baseline:
+    regressions = compare(results, args.baseline, args.tolerance)
+    for regression in regressions:
+      print(f'regression: {regression}')
+    sys.exit(1 if regressions else 0)
+
+if __name__ == '__main__':
+  main()
@@ -4,43 +4,102 @@
 __version__ = 0.1
 
 import QueryMantis
-import random
-import string
+import QueryCache
+import KmerBackend
+import MantisPool
 import os
 import sys
 import DBG
-import psutil
+import ProbeVariants
+import Frontier
+import Trace
+import Checkpoint
+import Bubbles
+import itertools
 
 ALPHA = 'ACGT'
 DUMMY_QUERY = 'A'*32
 KEY_ERR = -1
+PROBE_BATCH_SIZE = 4096
 
 
+def make_querier(mantis_exec, mantis_ds, db_dict=None, cache_file=None, workers=1, max_memory=None,
+                 backend='mantis', kmer_size=None, canonical=True):
+  """Spawns a Mantis process in query mode, or a pool of worker processes
+     that each round's queries are sharded across, and optionally wraps it
+     in a persistent cache of results. Returns the querier and the cache.
+
+     If canonical (the index's kmers are canonical, as Mantis' are by 
+     default), each batch of queries is canonicalised and deduplicated
+     before it is queried (and cached).
+
+     If backend is 'numpy', mantis_ds is instead a directory of FASTA/.concat
+     strain files (one per database) that are loaded into an in-process
+     NumpyBackend of kmer_size-mers, and mantis_exec is unused."""
+  if backend == 'numpy':
+    import NumpyBackend # Requires numpy, which the Mantis backend does not
+    qm = NumpyBackend.NumpyBackend(NumpyBackend.sequence_files(mantis_ds), kmer_size, canonical)
+  elif workers > 1:
+    qm = MantisPool.MantisPool(mantis_exec, mantis_ds, workers, db_dict, max_memory)
+  else:
+    query_file, result_file = QueryMantis.generate_filenames()
+    qm = QueryMantis.QueryMantis(mantis_exec, mantis_ds, query_file, result_file, db_dict)
+
+  # Optionally answer repeated queries from a persistent cache of results
+  cache = None
+  if cache_file:
+    cache = QueryCache.QueryCache(mantis_ds, cache_file, qm.kmer_params)
+    qm = QueryCache.CachedQuery(qm, cache)
+  if canonical:
+    qm = KmerBackend.CanonicalQuery(qm)
+  return qm, cache
+
 class iPCR:
-  """Constructs a De Bruijn Graph between two probes p1 and p2."""
+  """Constructs a De Bruijn Graph between two probes p1 and p2.
+
+     run() drives the construction to completion. The construction is also 
+     exposed as steps (probe_queries/add_probes, then round_queries/update
+     until done), so that several iPCR instances sharing one querier can
+     have their queries merged into a single batch per round (see BatchPCR)."""
 
   def __init__(self, p1=str(), p2=str(), mantis_exec=str(), 
                mantis_ds=str(), max_p1_mismatch=int(), max_p2_mismatch=int(),
-               k=int(), max_extension=int()):
+               k=int(), max_extension=int(), cache_file=None, workers=1, max_memory=None,
+               qm=None, backend='mantis', indels=False, max_frontier=-1,
+               canonical=True, packed=None, trace=None, checkpoint_file=None,
+               checkpoint_rounds=-1, checkpoint_seconds=-1, collapse_bubbles=False, track_unitigs=False):
     self.p1, self.p2 = p1, p2
     self.max_p1_mismatch, self.max_p2_mismatch = max_p1_mismatch, max_p2_mismatch
     self.mantis_exec = mantis_exec
     self.mantis_ds = mantis_ds
     self.k = k
-    self.max_extension = max_extension
-    self.db_dict = self.set_db_dict(mantis_ds)
+    self.max_extension = max_extension # Max depth of a path beyond p1*, -1 if unlimited
+    self.max_frontier = max_frontier # Max number of edges extended per round, -1 if unlimited
+    self.collapse_bubbles = collapse_bubbles # Whether to collapse SNP bubbles
+    self.indels = indels # Whether p1* and p2* probes may contain indels
+    self.track_unitigs = track_unitigs # Whether the graph keeps its unitigs up to date, reporting them per round
+    self.canonical = canonical # Whether kmers and their reverse complements are one node
+    # Whether the graph stores packed kmers, by default if edges fit in a uint64
+    self.packed = k + 1 <= DBG.MAX_PACKED_K if packed is None else packed
+    self.trace = Trace.Trace() if trace is None else trace # Per round statistics
+    # Periodically save the construction's state, from which run() resumes
+    self.checkpoint = None
+    if checkpoint_file:
+      self.checkpoint = Checkpoint.Checkpointer(checkpoint_file, checkpoint_rounds, checkpoint_seconds)
 
-    # Spawn Mantis process in query mode
-    # Create the query file (empty) to pass mantis is_file checks
-    query_file, result_file = self.generate_filenames()
-    self.qm = QueryMantis.QueryMantis(self.mantis_exec, self.mantis_ds, query_file, result_file)
+    # Spawn the querier (kmer membership backend), unless one is supplied, 
+    # e.g. shared with other iPCR instances. The Mantis index's kmers are
+    # assumed to be edges (k + 1) for the in-process backend.
+    if qm is None:
+      self.qm, self.cache = make_querier(self.mantis_exec, self.mantis_ds, None, cache_file,
+                                         workers, max_memory, backend, k + 1, canonical)
+    else:
+      self.qm, self.cache = qm, None
+    self.db_dict = self.qm.db_dict
 
+    self.dbg = None
+    self.frontier = None # Edges that the next round extends from
 
-  def set_db_dict(self, mantis_ds):
-    lst_file = mantis_ds + 'sampleid.lst'
-    with open(lst_file) as f:
-      dbs = [l.strip().split()[1] for l in f]
-    return {db:idx for idx, db in enumerate(dbs)}
 
   def add_probe_to_dbg(self, dbg, query_results, db_dict):
     """Constructs a De Brujin graph from the queried p1* or p2* probes that
@@ -49,15 +108,14 @@ class iPCR:
       if not self.exact_match(q_res):
         continue
       # Otherwise, add the exact matching probe to the dbg
-      dbs = [db_dict[db] for db in q_res['res'].keys() if q_res['num_kmers'] == q_res['res'][db]]
-      probe = q_res['query']
+      probe = q_res.query
       edges = [probe[i:i+(dbg.k+1)] for i in range(0, len(probe) - dbg.k)] # (k+1) not k because edge not node
       for edge in edges:
-        dbg.add_edge(edge, dbs)
+        dbg.add_edge(edge, q_res.dbs)
   
   def exact_match(self, q_res):
     """Returns True if query exactly matches at least one database."""
-    return any([True for num_kmers_in_db in q_res['res'].values() if num_kmers_in_db == q_res['num_kmers']])
+    return q_res.dbs != 0
         
   def update_dbg(self, query_results, dbg, db_dict):
     """Updates the De Bruijn graph by adding a set of edges that exactly
@@ -65,7 +123,6 @@ class iPCR:
     # Each queried edge that exactly matches at least one database will
     # be stored and returned (for the next update round).
     exact_matching_edges = list()
-    prior_edges = len(query_results) / 4
    
     # Iterate through queried edges and add exact matching edges to dbg
     for q_res in query_results:
@@ -74,15 +131,25 @@ class iPCR:
   
       # Determine whether the edge has made a loop. 
       # Loop detection reduces to determining whether the suffix
-      # node of the edge is already present in the dbg. 
-      edge = q_res['query']
+      # node of the edge is already present in the dbg, as read
+      # (a node whose reverse complement was read has not been
+      # walked on this strand, e.g. across a palindromic edge).
+      edge = q_res.query
       suffix_previously_present = False
-      if edge[1:] in dbg.nodes:
+      if dbg.has_read_node(edge[1:]):
         suffix_previously_present = True
+        # Unless the node is of a collapsed bubble branch, and was never extended from
+        if self.bubbles is not None and self.bubbles.extend_from(dbg.key(edge[1:])):
+          suffix_previously_present = False
   
-      # Add edge (and nodes)
-      dbs = [self.db_dict[db] for db in q_res['res'].keys() if q_res['num_kmers'] == q_res['res'][db]]
-      dbg.add_edge(q_res['query'], dbs)
+      # Add edge (and nodes), coloured by the bitmask of exact matching dbs
+      dbg.add_edge(edge, q_res.dbs)
+      self.inexact.discard(dbg.key(edge))
+
+      # A path that walks into a p2* probe has reached p2: stop extending it.
+      if edge[1:] in self.p2_nodes:
+        self.reached_p2.add(edge)
+        continue
   
       # If the suffix was already present, 
       # the dbg path(s) constructed from the edge constructed from
@@ -101,64 +168,239 @@ class iPCR:
   def generate_filenames(self):
     """Generates a unique pair of filenames for mantis query file and mantis results file
        used by QueryMantis."""
-    alphanums = string.ascii_uppercase + string.digits
-    query_file = ''.join([random.choice(alphanums) for i in range(0, 15)]) + '.query_file'
-    result_file = ''.join([random.choice(alphanums) for i in range(0, 15)]) + '.mantis.json'
-    while (query_file[:15] == result_file[:15] or 
-           os.path.isfile(query_file) or 
-           os.path.isfile(result_file)):
-      query_file = ''.join([random.choice(alphanums) for i in range(0, 15)]) + '.query_file'
-      result_file = ''.join([random.choice(alphanums) for i in range(0, 15)]) + '.mantis.json'
-    return query_file, result_file
+    return QueryMantis.generate_filenames()
   
+  def iter_probes(self, edit_dist, probe):
+    """Yields each p1* (or p2*) probe, of edit distance <= edit_dist from 
+       probe, exactly once. Edit distance is the Hamming distance unless
+       indels are enabled. Probes too short to contain an edge are skipped."""
+    if self.indels:
+      variants = ProbeVariants.edit_neighbourhood(probe, edit_dist)
+    else:
+      variants = ProbeVariants.hamming_neighbourhood(probe, edit_dist)
+    return (v for v in variants if len(v) >= self.k + 1)
+
   def build_probe_list(self, edit_dist, probe):
     """Builds a list of p1* probes, of edit distance <= edit_dist from probe."""
-    all_probes = set([probe])
-    if edit_dist > 0:
-      probe_list = [probe[:i] + ALPHA[j] + probe[i+1:] for i in range(0, len(probe)) for j in range(0, 4)]
-      for p in probe_list:
-        all_probes = all_probes.union(self.build_probe_list(edit_dist-1, p))
-    return sorted(list(all_probes))
+    return list(self.iter_probes(edit_dist, probe))
   
+  def probe_queries(self):
+    """Returns the p1* and p2* probes: the probes that match p1 and p2 
+       within an edit distance of max_p1_mismatch and max_p2_mismatch."""
+    self.p1_probe_list = self.build_probe_list(self.max_p1_mismatch, self.p1)
+    self.p2_probe_list = self.build_probe_list(self.max_p2_mismatch, self.p2)
+    return self.p1_probe_list + self.p2_probe_list
+
+  def init_dbg(self):
+    self.dbg = (DBG.PackedDBG if self.packed else DBG.DBG)(self.k, self.canonical, self.track_unitigs)
+    self.frontier = Frontier.Frontier()
+    self.bubbles = Bubbles.Bubbles(self.k) if self.collapse_bubbles else None
+    # Graph edges whose colour is only a lower bound: edges of the p1* and p2*
+    # probes, which a database may contain without containing the probe.
+    self.inexact = set()
+    self.p2_nodes, self.reached_p2 = set(), set()
+    self.truncated = list()
+    self.p1_hits, self.p2_hits = list(), list() # Exact matching p1* and p2* probes
+
+  def params(self):
+    """Returns the parameters that a checkpoint must have been made with to
+       be resumed from."""
+    return dict(p1=self.p1, p2=self.p2, k=self.k, max_p1_mismatch=self.max_p1_mismatch,
+                max_p2_mismatch=self.max_p2_mismatch, max_extension=self.max_extension,
+                max_frontier=self.max_frontier,
+                collapse_bubbles=self.collapse_bubbles,
+                indels=self.indels, canonical=self.canonical, packed=self.packed, db_dict=self.db_dict,
+                index=QueryCache.index_identity(self.mantis_ds) if os.path.isdir(self.mantis_ds) else None)
+
+  def state(self):
+    """Returns the state of the construction between rounds."""
+    return dict(params=self.params(), edges=self.dbg.state(),
+                frontier=self.frontier.edges, rounds=self.frontier.rounds,
+                inexact=self.inexact, p2_nodes=self.p2_nodes,
+                reached_p2=self.reached_p2, truncated=self.truncated,
+                p1_hits=self.p1_hits, p2_hits=self.p2_hits,
+                bubbles=self.bubbles.state() if self.bubbles is not None else None)
+
+  def restore(self, state):
+    """Restores the construction from a state(), returning False (leaving the
+       construction unchanged) if it was made with different parameters."""
+    if state['params'] != self.params():
+      return False
+    self.init_dbg()
+    self.dbg.restore(state['edges'])
+    self.frontier.edges, self.frontier.rounds = state['frontier'], state['rounds']
+    self.inexact, self.p2_nodes, self.reached_p2 = state['inexact'], state['p2_nodes'], state['reached_p2']
+    self.truncated = state['truncated']
+    self.p1_hits, self.p2_hits = state['p1_hits'], state['p2_hits']
+    if self.bubbles is not None:
+      self.bubbles.restore(state['bubbles'])
+    return True
+
+  def resume(self):
+    """Restores the construction from the last checkpoint, if there is one
+       made with the same parameters. Returns whether it was restored."""
+    state = self.checkpoint.load() if self.checkpoint else None
+    if state is None:
+      return False
+    if not self.restore(state):
+      print(f'Ignoring checkpoint {self.checkpoint.fname}, made with different parameters')
+      return False
+    print(f'Resuming from checkpoint {self.checkpoint.fname}: {len(self.dbg.edges)} edges, '
+          f'{len(self.frontier)} edges in the frontier')
+    return True
+
+  def add_probe_hits(self, query_results, is_p1):
+    """Adds the edges of exact matching p1* (is_p1) or p2* probes to the De
+       Bruijn graph. The last edge of each exact matching p1* probe is added
+       to the set of edges from which the De Bruijn graph edges will begin."""
+    for q_res in query_results:
+      self.add_probe_to_dbg(self.dbg, [q_res], self.db_dict)
+      if not self.exact_match(q_res):
+        continue
+      probe = q_res.query
+      (self.p1_hits if is_p1 else self.p2_hits).append(probe)
+      self.inexact.update(self.dbg.key(probe[i:i+self.k+1]) for i in range(0, len(probe) - self.k))
+      if is_p1:
+        self.frontier.edges[probe[-(self.k+1):]] = 0
+      else:
+        self.p2_nodes.update(probe[i:i+self.k] for i in range(0, len(probe) - self.k + 1))
+
+  def add_probes(self, query_results):
+    """Initializes the De Bruijn graph from the query results of 
+       probe_queries(), adding all edges of exact matching p1* and p2* probes."""
+    query_results = iter(query_results)
+    self.init_dbg()
+    self.add_probe_hits(itertools.islice(query_results, len(self.p1_probe_list)), True)
+    self.add_probe_hits(itertools.islice(query_results, len(self.p2_probe_list)), False)
+    self.start_frontier()
+
+  def start_frontier(self):
+    """Applies the budget to the frontier of the p1* probes' edges (depth 0),
+       before they are first extended."""
+    self.frontier.edges = self.apply_budget(self.frontier.edges)
+
+  def round_queries(self):
+    """Generates the edges to query in the next round. For each exact matching 
+       edge of the previous round, generate four new edges of form 
+       edge[1:] + {A, T, C, G}, one base deeper than the edge. Only new
+       edges are queried (see Frontier). If collapsing bubbles, the queries verifying
+       the bubbles' parked branches come last (see Bubbles)."""
+    return (self.frontier.expand(self.dbg, self.inexact) +
+            (self.bubbles.queries() if self.bubbles is not None else list()))
+
+  def update(self, query_results):
+    """Updates the De Bruijn graph with the query results of round_queries(),
+       and sets the edges to extend in the next round, within the budget.
+       If collapsing bubbles, the budget is applied before followers are
+       parked, and again once the unparked followers are merged back in."""
+    query_results = iter(query_results)
+    fwd_results = self.frontier.answer(itertools.islice(query_results, len(self.frontier.queries)))
+    extending = self.frontier.extended(self.update_dbg(fwd_results, self.dbg, self.db_dict))
+    if self.bubbles is not None:
+      extending = self.bubbles.update(self.dbg, self.apply_budget(extending))
+      extending.update(self.collapse(query_results))
+    self.frontier.edges = self.apply_budget(extending)
+
+  def collapse(self, query_results):
+    """Adds the branches of the bubbles verified by the query results to the
+       graph. Their colours are only lower bounds (databases containing the
+       whole branch), so they are inexact. Returns the followers that were
+       not collapsed, to extend as usual."""
+    added, unparked = self.bubbles.verify(query_results, self.dbg, self.p2_nodes)
+    self.inexact.update(self.dbg.key(edge) for edge in added)
+    return unparked
+
+  def apply_budget(self, edges):
+    """Removes the edges that exceed the search budget from a frontier (dict
+       of edge -> depth, the number of bases extended beyond p1*), recording
+       them as truncated. An edge at depth max_extension is not extended
+       further, and at most max_frontier edges (the shallowest) are kept."""
+    within = dict()
+    for e, depth in sorted(edges.items(), key=lambda item: (item[1], item[0])):
+      if self.max_extension >= 0 and depth >= self.max_extension:
+        self.truncated.append((e, depth, 'max_extension'))
+      elif self.max_frontier >= 0 and len(within) >= self.max_frontier:
+        self.truncated.append((e, depth, 'max_frontier'))
+      else:
+        within[e] = depth
+    return within
+
+  def report(self):
+    """Returns a summary of how the search terminated."""
+    lines = [f'p2* reached by {len(self.reached_p2)} edges, {len(self.truncated)} branches cut off by the budget']
+    candidates, saved = self.frontier.saved()
+    lines.append(f'{saved} of {candidates} candidate edges answered without querying')
+    if self.unitigs() is not None:
+      lines.append(f'{len(self.dbg.nodes)} nodes in {self.unitigs()} unitigs')
+    if self.bubbles is not None:
+      lacking = sum(1 for branch, dbs, lacks in self.bubbles.branches if lacks)
+      lines.append(f'{self.bubbles.collapsed} bubble branches collapsed ({lacking} in dbs the kept branch is '
+                   f'not in), {self.bubbles.unparked} parked branches extended as usual')
+      if self.bubbles.collapsed:
+        lines.append(f'Warning: collapsing bubbles is lossy: paths leaving the {self.bubbles.collapsed} collapsed '
+                     f'branches part way along (e.g. at indels or repeats) were not searched, so the graph may '
+                     f'lack sequence of some dbs. Run without --collapse-bubbles for an exhaustive search')
+    lines += [f'  cut off: {e} at depth {depth} ({reason})' for e, depth, reason in self.truncated]
+    if self.bubbles is not None:
+      lines += [f'  collapsed: {branch} in dbs {DBG.mask_to_dbs(dbs)}' +
+                (f', of which the kept branch is not in {DBG.mask_to_dbs(lacks)}' if lacks else '')
+                for branch, dbs, lacks in self.bubbles.branches]
+    return '\n'.join(lines)
+
+  def unitigs(self):
+    """Returns the number of unitigs of the graph, if they are tracked, else None."""
+    return None if self.dbg.unitigs is None else len(self.dbg.unitigs)
+
+  def collapsed(self):
+    """Returns the number of bubble branches collapsed, if collapsing, else None."""
+    return None if self.bubbles is None else self.bubbles.collapsed
+
+  def done(self):
+    return (len(self.frontier) == 0 and
+            (self.bubbles is None or len(self.bubbles) == 0))
+
   def run(self):
     """Reconstructs a coloured De Bruijn graph from a list of sequence 
        databases between two probes, p1 and p2 and their close variants (p1*, p2*)."""
   
-    # Initialize De Bruijn graph by adding all edges from p1* and p2* probes
-    # that match p1 and p2 probes within an edit distance of max_p1_mismatch, 
-    # and max_p2_mismatch respectively. 
-    dbg = DBG.DBG(self.k)
-    # Add p1* probes 
-    p1_probe_list = self.build_probe_list(self.max_p1_mismatch, self.p1)
-    p1_query_results = self.qm.query(p1_probe_list)
-    self.add_probe_to_dbg(dbg, p1_query_results, self.db_dict)
-    # Add p2* probes
-    p2_probe_list = self.build_probe_list(self.max_p2_mismatch, self.p2)
-    p2_query_results = self.qm.query(p2_probe_list)
-    self.add_probe_to_dbg(dbg, p2_query_results, self.db_dict)
-  
-    # Generate the set of edges from which the Dr Bruijn graph
-    # edges will begin (the edges at the end of exact matching
-    # p1* probes)
-    edges = set()
-    for q_res in p1_query_results:
-       if self.exact_match(q_res):
-       # If some database exactly matches the queried probe, then add its last kmer to extensions.
-         query_str = q_res['query']
-         edges.add(query_str[-(self.k+1):])
+    # Initialize De Bruijn graph by adding all edges from p1* and p2* probes
+    # that match p1 and p2 probes within an edit distance of max_p1_mismatch, 
+    # and max_p2_mismatch respectively. 
+    # The probes are generated and queried in batches, rather than as one list.
+    # Unless resuming from a checkpoint.
+    if not self.resume():
+      self.trace.begin_round(self.qm)
+      self.init_dbg()
+      n_probes = 0
+      for probe, edit_dist, is_p1 in ((self.p1, self.max_p1_mismatch, True),
+                                      (self.p2, self.max_p2_mismatch, False)):
+        for batch in ProbeVariants.batches(self.iter_probes(edit_dist, probe), PROBE_BATCH_SIZE):
+          n_probes += len(batch)
+          self.add_probe_hits(self.trace.timed(self.qm.iter_query(batch)), is_p1)
+      self.start_frontier()
+      self.trace.end_round(self.qm, 0, n_probes, 0, len(self.dbg.nodes), len(self.dbg.edges), self.unitigs(),
+                           self.collapsed())
   
-    # Begin De Brujin graph construction.
-    while len(edges) > 0:
-      # Generate new set of edges to query. For each exact matching edge of the
-      # previous iteration, generate four new edges of form edge[1:] + {A, T, C, G}. 
-      print(f'prior edges: {edges}')
-      edges = [e[1:] + base for e in edges for base in ALPHA]
-      edges = self.update_dbg(self.qm.query(edges), dbg, self.db_dict)
+    # Begin De Brujin graph construction.
+    while not self.done():
+      self.trace.begin_round(self.qm)
+      frontier = len(self.frontier)
+      queries = self.round_queries()
+      # Results are streamed into the DBG update as Mantis' output is parsed
+      self.update(self.trace.timed(self.qm.iter_query(queries)))
+      candidates, saved = self.frontier.rounds[-1]
+      self.trace.end_round(self.qm, frontier, len(queries), saved, len(self.dbg.nodes), len(self.dbg.edges),
+                           self.unitigs(), self.collapsed())
+      print(f'{saved} of {candidates} candidate edges answered without querying')
+      if self.checkpoint and self.checkpoint.due():
+        self.checkpoint.save(self.state())
       sys.stdout.flush()
   
     # Construction complete.
+    if self.checkpoint:
+      self.checkpoint.remove()
     self.qm.terminate()
-    return dbg
+    return self.dbg
 
 #def extensions_incomplete(extensions):
 # return any([e.extending for e in extensions])
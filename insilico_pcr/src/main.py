@@ -3,77 +3,184 @@
 # email: izaak.coleman1@gmail.com
 
 import sys
+import argparse
 import Extension
+import Amplicons
+import GraphIO
 import iPCR
 import os
-import timeit
+import Trace
 
 __version__ = 0.1
 
 ALPHA = {'A','C','G','T'}
-N_INPUT_PARAMS = 9
-OPTIONAL = 1
-
-def check_input_validity(input_params):
-  # Ensure correct number if input args
-  max_extension = -1
-  if len(input_params) == N_INPUT_PARAMS:
-    _, p1, p2, mantis_exec, mantis_ds, max_p1_mismatch, max_p2_mismatch, k, dbg_fname = input_params
-  elif len(input_params) == N_INPUT_PARAMS + OPTIONAL: 
-    _, p1, p2, mantis_exec, mantis_ds, max_p1_mismatch, max_p2_mismatch, k, dbg_fname, max_extension = input_params
-  else:
-    msg = "Usage: <exe> <p1> <p2> <path/to/mantis/executable> " +\
-          "<path/to/mantis/data/datastructure> <max p1 mismatches> "+\
-          "<max p2 mismatches> <k> <dbg pdf filename> <max_extension (optional)>"
-    raise Exception(msg)
 
+def add_search_args(parser):
+  """Adds the arguments shared by main.py and batch_main.py, which follow
+     the probe pair (or pair list) on the command line."""
+  parser.add_argument('mantis_exec', help='path/to/mantis/executable')
+  parser.add_argument('mantis_ds', help='path/to/mantis/data/datastructure')
+  parser.add_argument('max_p1_mismatch', help='max p1 mismatches')
+  parser.add_argument('max_p2_mismatch', help='max p2 mismatches')
+  parser.add_argument('k')
+  parser.add_argument('dbg_fname', help='prefix of the output files (De Bruijn graphs and amplicons)')
+  parser.add_argument('max_extension', nargs='?', default=-1,
+                      help='max number of bases a path is extended beyond p1* (optional, -1 for no limit); '
+                           'with 0, no edge beyond p1* is queried')
+  parser.add_argument('--cache', default=None,
+                      help='file of cached query results, reused between runs against the same mantis data structure')
+  parser.add_argument('--workers', type=int, default=1,
+                      help='number of mantis processes that each round of queries is sharded across')
+  parser.add_argument('--max-memory', type=float, default=None,
+                      help='GB of memory available to load the mantis data structure; caps --workers')
+  parser.add_argument('--indels', action='store_true',
+                      help='p1* and p2* probes are all probes within edit distance (rather than Hamming distance) of p1 and p2')
+  parser.add_argument('--max-frontier', type=int, default=-1,
+                      help='max number of edges extended per round; the deepest edges beyond it are cut off')
+  parser.add_argument('--collapse-bubbles', action='store_true',
+                      help='park the minor branches of SNP bubbles while the major branch extends, verifying '
+                           'each with one query once the major branch has extended k bases. Lossy: paths '
+                           'leaving a collapsed branch part way along (e.g. at indels or repeats) are not '
+                           'searched')
+  parser.add_argument('--track-unitigs', action='store_true',
+                      help='keep the unitigs of the De Bruijn graph up to date as it grows, reporting their '
+                           'number per round (in the trace), rather than computing them when compressing')
+  parser.add_argument('--stranded', action='store_true',
+                      help='the index is strand specific (not canonical): do not treat a kmer and its '
+                           'reverse complement as the same node')
+  parser.add_argument('--unpacked', action='store_true',
+                      help='store the De Bruijn graph as strings, rather than as kmers packed into ints (k < 32)')
+  parser.add_argument('--trace', default=None,
+                      help='JSONL file to write a record of statistics (queries, timings, graph size, RSS) per round to')
+  parser.add_argument('--profile', default=None,
+                      help='file to dump cProfile stats of the construction to (read with pstats)')
+  parser.add_argument('--tracemalloc', action='store_true',
+                      help='trace allocations, listing the top allocation sites in the summary')
+  parser.add_argument('--backend', choices=['mantis', 'numpy'], default='mantis',
+                      help='kmer membership backend. numpy loads the (k+1)-mers of the FASTA/.concat strain '
+                           'files in mantis_ds in process, without mantis (mantis_exec is ignored)')
+  parser.add_argument('--max-amplicon-len', type=int, default=10000,
+                      help='max length of the p1* to p2* amplicons written to <dbg_fname>.amplicons.fa/.tsv '
+                           '(-1 for no limit); cycles are followed up to the copies their k-mers tell apart')
+  parser.add_argument('--max-amplicons', type=int, default=1000,
+                      help='max number of amplicons enumerated (-1 for no limit)')
+  parser.add_argument('--formats', nargs='+', choices=['gfa', 'bin'], default=['gfa'],
+                      help='formats to write the De Bruijn graph in, before and after compression: GFA1 '
+                           '(<dbg_fname>.gfa, .cmp.gfa) and/or memory mappable binary (<dbg_fname>.dbg, .cmp.dbg)')
+  parser.add_argument('--render', action='store_true',
+                      help='also render the De Bruijn graph with graphviz (<dbg_fname>.gv, .gv.cmp)')
+  parser.add_argument('--max-render-nodes', type=int, default=1000,
+                      help='render at most this many nodes, those nearest the sources (-1 for no limit)')
+
+def parse_args(argv):
+  parser = argparse.ArgumentParser(description='Assembles the genome between a pair of probes p1, p2 from a set of sequencing databases.')
+  parser.add_argument('p1')
+  parser.add_argument('p2')
+  add_search_args(parser)
+  parser.add_argument('--checkpoint', default=None,
+                      help='file to periodically save the construction to, and resume it from if it exists')
+  parser.add_argument('--checkpoint-rounds', type=int, default=100,
+                      help='rounds between checkpoints (-1 to only checkpoint by time)')
+  parser.add_argument('--checkpoint-seconds', type=float, default=600,
+                      help='seconds between checkpoints (-1 to only checkpoint by rounds)')
+  return parser.parse_args(argv[1:])
+
+def check_search_args(args):
   # Correctly set input arg types
   try:
-    max_p1_mismatch, max_p2_mismatch = int(max_p1_mismatch), int(max_p2_mismatch)
+    args.max_p1_mismatch, args.max_p2_mismatch = int(args.max_p1_mismatch), int(args.max_p2_mismatch)
   except ValueError as e:
     print("Both the max p1 an p2 mismatch values must be integers.")
     sys.exit()
   try:
-    max_extension = int(max_extension)
+    args.max_extension = int(args.max_extension)
   except ValueError as e:
     print("Max extension must be an integer.")
     sys.exit()
-  if set(p1.upper()) != ALPHA or set(p2.upper()) != ALPHA:
-    raise Exception(f"Either probe p1: {p1} or p2: {p2} contains non-ATCG character, which is invalid.")
-  else:
-    p1, p2  = p1.upper(), p2.upper()
 
-  # Check paths to Mantis exe and Mantis db are valid
-  if os.path.isfile(mantis_exec) == False or os.path.isdir(mantis_ds) == False:
+  # Check paths to Mantis exe and Mantis db are valid
+  if (args.backend == 'mantis' and os.path.isfile(args.mantis_exec) == False) or os.path.isdir(args.mantis_ds) == False:
     raise Exception("Either the supplied mantis executable path or mantis data structure path does not exist. Check paths are valid.")
 
-  # Check k is an integer 
+  # Check k is an integer
   try:
-    k = int(k)
+    args.k = int(args.k)
   except ValueError as e:
-    print(f'{k} is not an integer.')
+    print(f'{args.k} is not an integer.')
     sys.exit()
+  return args
+
+def check_probes(p1, p2, k):
+  """Checks a probe pair is valid for k, returning the upper cased pair."""
+  if not set(p1.upper()) <= ALPHA or not set(p2.upper()) <= ALPHA:
+    raise Exception(f"Either probe p1: {p1} or p2: {p2} contains non-ATCG character, which is invalid.")
+  else:
+    p1, p2  = p1.upper(), p2.upper()
 
   if len(p1) < k + 1 or len(p2) < k + 1:
     raise Exception(f'p1 and p2 must have length >= {k + 1}. Current lengths: p1 {len(p1)}, p2 {len(p2)}')
-  return p1, p2, mantis_exec, mantis_ds, max_p1_mismatch, max_p2_mismatch, k, dbg_fname, max_extension
+  return p1, p2
+
+def check_input_validity(args):
+  args = check_search_args(args)
+  args.p1, args.p2 = check_probes(args.p1, args.p2, args.k)
+  return args
+
+def ipcr_args(args):
+  """Returns the keyword arguments configuring iPCR (and its querier) from the parsed args."""
+  return dict(cache_file=args.cache, workers=args.workers, backend=args.backend, indels=args.indels,
+              max_frontier=args.max_frontier, collapse_bubbles=args.collapse_bubbles,
+              track_unitigs=args.track_unitigs,
+              canonical=not args.stranded, packed=False if args.unpacked else None,
+              max_memory=None if args.max_memory is None else args.max_memory * 2**30)
+
+def make_trace(args):
+  return Trace.Trace(args.trace, args.profile, args.tracemalloc)
+
+def write_dbg(dbg, dbg_fname, args, db_dict=None):
+  """Writes the De Bruijn graph, before and after compression, in each of
+     args.formats, and renders it if args.render."""
+  for suffix in ('', '.cmp'):
+    if suffix:
+      dbg.compress()
+    if 'gfa' in args.formats:
+      GraphIO.write_gfa(dbg, dbg_fname + suffix + '.gfa', db_dict)
+    if 'bin' in args.formats:
+      GraphIO.write_binary(dbg, dbg_fname + suffix + '.dbg')
+    if args.render:
+      dbg.render(dbg_fname + '.gv' + suffix, args.max_render_nodes)
+
+def write_amplicons(pcr, dbg, fname, args):
+  """Writes the amplicons between the p1* and p2* probes of the compressed
+     De Bruijn graph of an iPCR run, and the databases containing each."""
+  amplicons = Amplicons.amplicons(dbg, pcr.p1_hits, pcr.p2_hits, args.max_amplicon_len, args.max_amplicons)
+  groups = Amplicons.write(amplicons, pcr.db_dict, fname + '.amplicons')
+  print(f'{sum(groups.values())} amplicons written to {fname}.amplicons.fa and {fname}.amplicons.tsv')
+  for dbs, n in sorted(groups.items(), key=lambda group: -group[1]):
+    print(f'  {n} contained by {Amplicons.db_names(dbs, pcr.db_dict)}')
 
 def main():
-  '''Assembles the genome between a pair of probes p1, p2 from a 
+  '''Assembles the genome between a pair of probes p1, p2 from a
      set of sequencing databases, returning any non-SNP variant sequences. '''
   # Check input validity
-  p1, p2, mantis_exec, mantis_ds, max_p1_mismatch, max_p2_mismatch, k, dbg_fname, max_extension = check_input_validity(sys.argv)
-  
+  args = check_input_validity(parse_args(sys.argv))
+
   # Initialize iPCR instance.
-  start = timeit.timeit()
-  ipcr = iPCR.iPCR(p1, p2, mantis_exec, mantis_ds, max_p1_mismatch, max_p2_mismatch, k, max_extension)
-  # Run iPCR. Constructed De Bruijn graph output. 
+  trace = make_trace(args)
+  trace.start()
+  ipcr = iPCR.iPCR(args.p1, args.p2, args.mantis_exec, args.mantis_ds, args.max_p1_mismatch,
+                   args.max_p2_mismatch, args.k, args.max_extension, trace=trace,
+                   checkpoint_file=args.checkpoint, checkpoint_rounds=args.checkpoint_rounds,
+                   checkpoint_seconds=args.checkpoint_seconds, **ipcr_args(args))
+  # Run iPCR. Constructed De Bruijn graph output.
   dbg = ipcr.run()
-  # Write De Bruijn graph.
-  dbg.render(dbg_fname + '.gv')
-  dbg.compress()
-  dbg.render(dbg_fname + '.gv.cmp')
-  end = timeit.timeit()
-  print(end - start)
+  trace.finish()
+  print(ipcr.report())
+  if ipcr.cache:
+    print(ipcr.cache.summary())
+  print(trace.summary())
+  # Write De Bruijn graph, and the amplicons of the compressed graph.
+  write_dbg(dbg, args.dbg_fname, args, ipcr.db_dict)
+  write_amplicons(ipcr, dbg, args.dbg_fname, args)
 if __name__ == '__main__':
   main()
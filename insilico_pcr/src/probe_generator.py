@@ -1,29 +1,122 @@
 import sys
+import os
+import csv
 import gzip
+import re
+
+USAGE = ('Usage: <exe> <p1_boundary> <p2_boundary> <left_offset> <right_offset> <units> <probe_len> <concat_file>\n'
+         '       <exe> --batch <left_offset> <right_offset> <units> <probe_len> <concat_dir> <out_csv> <sgv_csv> [<sgv_csv> ...]')
+
+def probe_positions(p1_boundary, p2_boundary, left_offset, right_offset, units):
+  """Returns the start of p1 and the end of p2 in the genome, the region's
+     boundaries being in units of bases."""
+  return (p1_boundary - left_offset)*units, (p2_boundary + right_offset + 1)*units
+
+def read_genome(fname):
+  """Returns the sequence of a strain .concat file, gzipped or not, as bytes."""
+  with open(fname, 'rb') as f:
+    gzipped = f.read(2) == b'\x1f\x8b'
+  with (gzip.open(fname) if gzipped else open(fname, 'rb')) as f:
+    return f.read().strip()
+
+def extract_probes(genome, p1_pos, p2_pos, probe_len):
+  """Returns the probes p1, p2 starting at p1_pos and ending at p2_pos, or
+     None if either is not in the genome."""
+  if p1_pos < 0 or p2_pos > len(genome):
+    return None
+  return genome[p1_pos: p1_pos + probe_len].decode('utf-8'), genome[p2_pos - probe_len: p2_pos].decode('utf-8')
+
+def parse_sgv(sgv):
+  """Parses a region org:start_end;start_end;..., returning the organism and
+     the first and last bin of the region. Characters other than the bins
+     (e.g. the >>> some regions are marked with) are ignored."""
+  org, _, segments = sgv.rpartition(':')
+  bins = [int(b) for b in re.findall(r'\d+', segments)]
+  if not org or not bins:
+    raise Exception(f'{sgv} is not a region of the form org:start_end;start_end')
+  return org, min(bins), max(bins)
+
+def read_sgvs(fname):
+  """Reads the regions of a dsgv/vsgv csv file (columns: index, region),
+     naming each <csv name>_<index>. Returns a list of (name, region)."""
+  name = os.path.basename(fname).split('.')[0]
+  with open(fname) as f:
+    rows = list(csv.reader(f))
+  return [(f'{name}_{row[0]}', row[1].strip()) for row in rows[1:] if len(row) > 1 and row[1].strip()]
+
+def concat_file(concat_dir, org):
+  """Returns the path of the organism's .concat file, gzipped or not."""
+  fname = os.path.join(concat_dir, org + '.concat')
+  return fname + '.gz' if os.path.exists(fname + '.gz') else fname
+
+def batch_probes(regions, concat_dir, left_offset, right_offset, units, probe_len):
+  """Yields (name, region, organism, p1, p2) for each of regions, a list of
+     (name, region), reading the genome of each organism once."""
+  by_org = dict()
+  for name, sgv in regions:
+    try:
+      org, p1_boundary, p2_boundary = parse_sgv(sgv)
+    except Exception as e:
+      print(f'Skipping {name}: {e}', file=sys.stderr)
+      continue
+    by_org.setdefault(org, list()).append((name, sgv, p1_boundary, p2_boundary))
+  for org, org_regions in by_org.items():
+    fname = concat_file(concat_dir, org)
+    if not os.path.exists(fname):
+      print(f'Skipping {len(org_regions)} regions of {org}: {fname} not found', file=sys.stderr)
+      continue
+    genome = read_genome(fname)
+    for name, sgv, p1_boundary, p2_boundary in org_regions:
+      p1_pos, p2_pos = probe_positions(p1_boundary, p2_boundary, left_offset, right_offset, units)
+      probes = extract_probes(genome, p1_pos, p2_pos, probe_len)
+      if probes is None:
+        print(f'Skipping {name} ({sgv}): probe positions p1 {p1_pos} or p2 {p2_pos} are not in range',
+              file=sys.stderr)
+        continue
+      yield (name, sgv, org) + probes
+
+def batch_main(argv):
+  """Extracts the probes of every region of the sgv csv files, writing a
+     csv of probe pairs (region, p1, p2, organism, sgv) in their input order,
+     e.g. for batch_main.py."""
+  if len(argv) < 7:
+    print(USAGE)
+    sys.exit()
+  left_offset, right_offset, units, probe_len = map(int, argv[:4])
+  concat_dir, out_csv = argv[4], argv[5]
+  regions = [region for fname in argv[6:] for region in read_sgvs(fname)]
+  order = {name: i for i, (name, sgv) in enumerate(regions)}
+  pairs = sorted(batch_probes(regions, concat_dir, left_offset, right_offset, units, probe_len),
+                 key=lambda pair: order[pair[0]])
+  with open(out_csv, 'w', newline='') as f:
+    writer = csv.writer(f)
+    writer.writerow(['region', 'p1', 'p2', 'organism', 'sgv'])
+    for name, sgv, org, p1, p2 in pairs:
+      writer.writerow([name, p1, p2, org, sgv])
+  print(f'{len(pairs)} of {len(regions)} regions written to {out_csv}')
 
 def main():
+  if len(sys.argv) > 1 and sys.argv[1] == '--batch':
+    batch_main(sys.argv[2:])
+    return
 
   if len(sys.argv) != 8:
-    print('Usage: <exe> <p1_boundary> <p2_boundary> <left_offset> <right_offset> <units> <probe_len> <concat_file>')
+    print(USAGE)
     sys.exit()
 
-  p1_pos = (int(sys.argv[1]) - int(sys.argv[3]))*int(sys.argv[5])
-  p2_pos = (int(sys.argv[2]) + int(sys.argv[4]) + 1)*int(sys.argv[5])
-
-  with gzip.open(sys.argv[7]) as f:
-    contig = f.read().strip().decode('utf-8')
+  p1_pos, p2_pos = probe_positions(*(int(a) for a in sys.argv[1:6]))
+  contig = read_genome(sys.argv[7])
 
-  if p1_pos < 0 or p2_pos > len(contig):
+  probe_len = int(sys.argv[6])
+  probes = extract_probes(contig, p1_pos, p2_pos, probe_len)
+  if probes is None:
     print(f'probe positions p1 {p1_pos} or p2 {p2_pos} are not in range')
     sys.exit()
-  probe_len = int(sys.argv[6]) 
   print(p1_pos)
   print(p2_pos)
-  p1 = contig[p1_pos: p1_pos + probe_len]
-  p2 = contig[p2_pos - probe_len: p2_pos]
+  p1, p2 = probes
   print(f'{sys.argv[7]}, {p1}, {p2}')
 
 
 if __name__ == '__main__':
   main()
-